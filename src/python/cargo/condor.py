@@ -156,6 +156,7 @@ def submit_condor_workers(
     group = "GRAD",
     project = "AI_ROBOTICS",
     condor_home = default_condor_home(),
+    worker_arguments = [],
     ):
     # prepare the working directories
     working_paths = [os.path.join(condor_home, "%i" % i) for i in xrange(workers)]
@@ -216,12 +217,12 @@ def submit_condor_workers(
         .blank()
 
     for working_path in working_paths:
-        arg_format = '"-c \'%s ""$0"" $@\' -m cargo.tools.labor.work2 %s $(Cluster).$(Process)"'
+        arg_format = '"-c \'%s ""$0"" $@\' -m cargo.tools.labor.work2 %s %s $(Cluster).$(Process)"'
 
         submit \
             .pairs(
                 Initialdir = working_path,
-                Arguments = arg_format % (sys.executable, req_address),
+                Arguments = arg_format % (sys.executable, " ".join(worker_arguments), req_address),
                 ) \
             .queue(1) \
             .blank()
@@ -2,41 +2,414 @@
 
 from __future__ import absolute_import
 
+__all__ = [
+    "get_task",
+    "get_context",
+    "initialize_worker",
+    "TaskCancelledError",
+    "Cancellation",
+    "Postponement",
+    "WorkerSetup",
+    "Histogram",
+    "Metrics",
+    "MessageCodec",
+    "send_pyobj_gz",
+    "recv_pyobj_gz",
+    "recv_routed_pyobj_gz",
+    "LeaseSizer",
+    "Message",
+    "ApplyMessage",
+    "ErrorMessage",
+    "InterruptedMessage",
+    "DoneMessage",
+    "PartialResult",
+    "BatchMessage",
+    "HeartbeatMessage",
+    "Task",
+    "digest_task",
+    "get_task_family",
+    "CostModel",
+    "assign_stable_keys",
+    "iassign_stable_keys",
+    "ResultJournal",
+    "ResultCache",
+    "SharedArgument",
+    "SharedArgumentIndex",
+    "SharedArgumentCache",
+    "get_shared_memory_root",
+    "SharedMemoryCodec",
+    "TaskState",
+    "WorkerState",
+    "Speculator",
+    "TaskQueue",
+    "ManagerCore",
+    "RemoteManager",
+    "launch_remote_workers",
+    "WorkerPool",
+    "CondorWorkerPool",
+    "ProcessWorkerPool",
+    "SSHWorkerPool",
+    "LocalWorkerProcess",
+    "LocalManager",
+    "launch_local_workers",
+    "ThreadWorker",
+    "ThreadManager",
+    "launch_thread_workers",
+    "HybridManager",
+    "ConsumedList",
+    "describe_count",
+    "compute_serially",
+    "do_or_distribute",
+    "TreeReducer",
+    "reduce_or_distribute",
+    "ResultStream",
+    "iterate_or_distribute",
+    ]
+
 import os
 import sys
+import bz2
+import errno
+import json
+import math
 import time
 import zlib
+import heapq
+import struct
 import socket
 import signal
+import subprocess
+import copy
+import contextlib
+import shutil
+import tempfile
+import types
 import random
+import threading
+import logging
 import traceback
+import itertools
 import collections
 import multiprocessing
+import Queue as queue
 import cPickle as pickle
+import cStringIO as StringIO
 import numpy
 import cargo
 
 logger = cargo.get_logger(__name__, level = "INFO")
 
 _current_task = None
+_worker_context = None
+_thread_state = threading.local()
 
 def get_task():
     """Get the currently-executing task, if any."""
 
-    return _current_task
+    return getattr(_thread_state, "task", _current_task)
+
+def get_context():
+    """Get the context built by this worker's initializer, if any."""
+
+    return _worker_context
+
+def initialize_worker(initializer):
+    """Run a worker initializer, making its result the worker-local context."""
+
+    global _worker_context
+
+    if initializer is not None:
+        logger.info("initializing worker")
+
+        _worker_context = initializer()
+
+class TaskCancelledError(BaseException):
+    """The current task was cancelled; raised within it.
+
+    Like KeyboardInterrupt, it is not an Exception, so that tasks which
+    catch every Exception do not swallow it.
+    """
+
+class Cancellation(object):
+    """Notice, sent to a remote worker, that a task it holds was cancelled."""
+
+    def __init__(self, key):
+        self.key = key
+
+class Postponement(object):
+    """Reply, to a remote worker's request for tasks, to repeat it after some seconds."""
+
+    def __init__(self, seconds = 0.05):
+        self.seconds = seconds
+
+class WorkerSetup(object):
+    """Per-process setup, sent to a remote worker ahead of its first tasks."""
+
+    def __init__(self, initializer, combine = None):
+        self.initializer = initializer
+        self.combine = combine
+
+class Histogram(object):
+    """Summarize a stream of nonnegative values in power-of-two buckets."""
+
+    def __init__(self):
+        """Initialize."""
+
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.buckets = collections.defaultdict(int)
+
+    def add(self, value):
+        """Record one value."""
+
+        self.count += 1
+        self.total += value
+
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+        # values in [2**(e - 1), 2**e) land in bucket e
+        self.buckets[math.frexp(value)[1]] += 1
+
+    def quantile(self, q):
+        """Return an upper bound on the q-quantile of the recorded values."""
+
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+
+        for exponent in sorted(self.buckets):
+            seen += self.buckets[exponent]
+
+            if seen >= rank:
+                return min(self.maximum, math.ldexp(1.0, exponent))
+
+        return self.maximum
+
+    def summarize(self):
+        """Return a JSON-friendly summary."""
+
+        if self.count == 0:
+            return {"count": 0}
+        else:
+            return {
+                "count": self.count,
+                "total": self.total,
+                "mean": self.total / self.count,
+                "min": self.minimum,
+                "max": self.maximum,
+                "p50": self.quantile(0.5),
+                "p90": self.quantile(0.9),
+                "p99": self.quantile(0.99),
+                }
+
+class Metrics(object):
+    """Counters and histograms, cheap to update and summarized on demand."""
+
+    def __init__(self):
+        """Initialize."""
+
+        self.started = time.time()
+        self.counters = collections.defaultdict(int)
+        self.histograms = collections.defaultdict(Histogram)
+
+    def count(self, name, amount = 1):
+        """Increment a counter."""
+
+        self.counters[name] += amount
+
+    def observe(self, name, value):
+        """Add a value to a histogram."""
+
+        self.histograms[name].add(value)
+
+    def summarize(self):
+        """Return a JSON-friendly summary."""
+
+        return {
+            "elapsed": time.time() - self.started,
+            "counters": dict(self.counters),
+            "histograms": dict((k, v.summarize()) for (k, v) in self.histograms.iteritems()),
+            }
+
+    def dumps(self, **extra):
+        """Return the summary, with any extra fields, as a line of JSON."""
+
+        summary = self.summarize()
+
+        summary.update(extra)
+
+        return json.dumps(summary, sort_keys = True)
+
+class MessageCodec(object):
+    """Serialize messages into zeromq frames, and back.
+
+    Messages are pickled with the highest protocol, and the pickle is
+    compressed only if it exceeds threshold bytes. Contiguous numpy arrays of
+    at least array_threshold bytes, wherever they appear in a message, travel
+    as separate raw frames rather than through the pickle; on receipt they
+    are copied into writeable arrays. Traffic is tallied in metrics, if
+    given.
+    """
+
+    compressors = {
+        "none": (lambda data, level: data, lambda data: data),
+        "zlib": (zlib.compress, zlib.decompress),
+        "bz2": (bz2.compress, bz2.decompress),
+        }
+
+    def __init__(
+        self,
+        compressor = "zlib",
+        level = 1,
+        threshold = 1024,
+        array_threshold = 4096,
+        metrics = None,
+        ):
+        """Initialize."""
+
+        if compressor not in self.compressors:
+            raise ValueError("unknown compressor \"{0}\"".format(compressor))
+
+        self.compressor = compressor
+        self.level = level
+        self.threshold = threshold
+        self.array_threshold = array_threshold
+        self.metrics = metrics
+
+    def encode(self, message):
+        """Return the list of frames encoding a message."""
+
+        arrays = []
+
+        def persistent_id(value):
+            if isinstance(value, numpy.ndarray) \
+                and value.nbytes >= self.array_threshold \
+                and not value.dtype.hasobject:
+                arrays.append(numpy.ascontiguousarray(value))
+
+                return (len(arrays) - 1, value.dtype, value.shape)
+            else:
+                return None
+
+        pickled_file = StringIO.StringIO()
+        pickler = pickle.Pickler(pickled_file, pickle.HIGHEST_PROTOCOL)
+
+        pickler.inst_persistent_id = persistent_id
+
+        pickler.dump(message)
+
+        pickled = pickled_file.getvalue()
+
+        if len(pickled) < self.threshold:
+            (name, body) = ("none", pickled)
+        else:
+            (compress, _) = self.compressors[self.compressor]
+
+            (name, body) = (self.compressor, compress(pickled, self.level))
+
+        if self.metrics is not None:
+            self.metrics.count("codec.messages_sent")
+            self.metrics.count("codec.pickled_bytes", len(pickled))
+            self.metrics.count("codec.sent_bytes", len(body) + sum(a.nbytes for a in arrays))
+
+            if name != "none":
+                self.metrics.observe("codec.compression_ratio", float(len(pickled)) / len(body))
+
+        return [name, body] + arrays
+
+    def decode(self, frames):
+        """Return the message encoded by a list of frames."""
+
+        def persistent_load((index, dtype, shape)):
+            frame = frames[2 + index]
+
+            # copy out of the (read-only) frame, so that remote tasks, like
+            # local ones, may modify their arguments in place
+            raw = numpy.frombuffer(bytearray(getattr(frame, "buffer", frame)), numpy.uint8)
+
+            return raw.view(dtype).reshape(shape)
+
+        (name, body) = [str(getattr(frame, "bytes", frame)) for frame in frames[:2]]
+
+        if self.metrics is not None:
+            self.metrics.count("codec.messages_received")
+            self.metrics.count("codec.received_bytes", sum(len(frame) for frame in frames[1:]))
+
+        (_, decompress) = self.compressors[name]
+        unpickler = pickle.Unpickler(StringIO.StringIO(decompress(body)))
+
+        unpickler.persistent_load = persistent_load
+
+        return unpickler.load()
+
+default_codec = MessageCodec()
+
+def send_pyobj_gz(zmq_socket, message, envelope = [], codec = None):
+    if codec is None:
+        codec = default_codec
+
+    zmq_socket.send_multipart(envelope + codec.encode(message), copy = False)
 
-def send_pyobj_gz(zmq_socket, message):
-    pickled = pickle.dumps(message)
-    compressed = zlib.compress(pickled, 1)
+def recv_pyobj_gz(zmq_socket, codec = None):
+    if codec is None:
+        codec = default_codec
 
-    zmq_socket.send(compressed)
+    return codec.decode(zmq_socket.recv_multipart(copy = False))
 
-def recv_pyobj_gz(zmq_socket):
-    compressed = zmq_socket.recv()
-    decompressed = zlib.decompress(compressed)
-    unpickled = pickle.loads(decompressed)
+def recv_routed_pyobj_gz(zmq_socket, codec = None):
+    """Receive through a ROUTER socket; return the envelope and message."""
 
-    return unpickled
+    if codec is None:
+        codec = default_codec
+
+    frames = zmq_socket.recv_multipart(copy = False)
+
+    # REQ peers, unlike DEALER peers, add an empty delimiter frame
+    if len(frames[1]) == 0:
+        return (frames[:2], codec.decode(frames[2:]))
+    else:
+        return (frames[:1], codec.decode(frames[1:]))
+
+class LeaseSizer(object):
+    """Choose how many tasks a worker should lease per request."""
+
+    def __init__(self, fixed = 0, target = 1.0, maximum = 64, smoothing = 0.25):
+        """Initialize.
+
+        A nonzero fixed size disables adaptation; otherwise leases are sized so
+        that each lasts roughly target seconds.
+        """
+
+        self.fixed = fixed
+        self.target = target
+        self.maximum = maximum
+        self.smoothing = smoothing
+        self.mean = None
+
+    def observe(self, seconds):
+        """Record the duration of one completed task."""
+
+        if self.mean is None:
+            self.mean = seconds
+        else:
+            self.mean += self.smoothing * (seconds - self.mean)
+
+    def size(self):
+        """Return the number of tasks to request next."""
+
+        if self.fixed > 0:
+            return self.fixed
+        elif self.mean is None:
+            return 1
+        else:
+            return max(1, min(self.maximum, int(self.target / max(self.mean, 1e-6))))
 
 class Message(object):
     """Message from a worker."""
@@ -50,10 +423,19 @@ class Message(object):
         return "worker {0} (pid {1} on {2}) {3}".format(self.sender, self.pid, self.host, text)
 
 class ApplyMessage(Message):
-    """A worker wants a unit of work."""
+    """A worker wants one or more units of work."""
+
+    def __init__(self, sender, count = 1, cached = []):
+        Message.__init__(self, sender)
+
+        self.count = count
+        self.cached = cached
 
     def get_summary(self):
-        return self.make_summary("requested a job")
+        if self.count == 1:
+            return self.make_summary("requested a job")
+        else:
+            return self.make_summary("requested {0} jobs".format(self.count))
 
 class ErrorMessage(Message):
     """An error occurred in a task."""
@@ -70,12 +452,16 @@ class ErrorMessage(Message):
         return self.make_summary("encountered an error ({0})".format(brief))
 
 class InterruptedMessage(Message):
-    """A worker was interrupted."""
+    """A worker was interrupted.
+
+    Checkpoints saved by its interrupted tasks are keyed by task key.
+    """
 
-    def __init__(self, sender, key):
+    def __init__(self, sender, key, checkpoints = {}):
         Message.__init__(self, sender)
 
         self.key = key
+        self.checkpoints = checkpoints
 
     def get_summary(self):
         return self.make_summary("was interrupted")
@@ -83,23 +469,102 @@ class InterruptedMessage(Message):
 class DoneMessage(Message):
     """A task was completed."""
 
-    def __init__(self, sender, key, result):
+    def __init__(self, sender, key, result, duration = None):
         Message.__init__(self, sender)
 
         self.key = key
         self.result = result
+        self.duration = duration
 
     def get_summary(self):
         return self.make_summary("finished job {0}".format(self.key))
 
+class PartialResult(object):
+    """The combined results of several tasks."""
+
+    def __init__(self, value):
+        self.value = value
+
+class BatchMessage(Message):
+    """Several tasks were completed, and more work is wanted.
+
+    If the worker has combined their results into a partial aggregate, the
+    individual messages carry no results.
+    """
+
+    def __init__(self, sender, messages, count = 1, cached = [], partial = None):
+        Message.__init__(self, sender)
+
+        self.messages = messages
+        self.count = count
+        self.cached = cached
+        self.partial = partial
+
+    def get_summary(self):
+        return self.make_summary(
+            "finished {0} jobs and requested {1}".format(len(self.messages), self.count),
+            )
+
+class HeartbeatMessage(Message):
+    """A worker is alive, and possibly working on a task, for elapsed seconds so far.
+
+    Elapsed time, rather than a start time, is reported, since the clocks of
+    worker and manager may disagree.
+    """
+
+    def __init__(self, sender, key = None, elapsed = None):
+        Message.__init__(self, sender)
+
+        self.key = key
+        self.elapsed = elapsed
+
+    def get_summary(self):
+        return self.make_summary("is alive")
+
 class Task(object):
-    """One unit of distributable work."""
+    """One unit of distributable work.
+
+    An optional cost estimate (in seconds, or any consistent unit) and
+    priority guide scheduling: higher-priority tasks start first and, among
+    equals, more costly ones do. Tasks without an estimate are assigned one
+    learned from the run times of their family.
+
+    A task passed directly as a positional or keyword argument of another is
+    a dependency: the dependent starts only once it has finished, and
+    receives its result in its place.
+
+    Tasks that share a group race one another: once any of them completes,
+    the rest are cancelled.
+
+    A running task, found through get_task(), may save() its intermediate
+    state; if its worker is interrupted, the next worker assigned the task
+    receives that state as its checkpoint, from which to resume.
 
-    def __init__(self, call, args = [], kwargs = {}):
+    Tasks are slotted, since a run may hold millions of them.
+    """
+
+    __slots__ = ["call", "args", "kwargs", "cost", "priority", "group", "checkpoint", "key"]
+
+    def __init__(self, call, args = [], kwargs = {}, key = None, cost = None, priority = 0, group = None):
         self.call = call
         self.args = args
         self.kwargs = kwargs
-        self.key = id(self)
+        self.cost = cost
+        self.priority = priority
+        self.group = group
+        self.checkpoint = None
+
+        if key is None:
+            self.key = id(self)
+        else:
+            self.key = key
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in Task.__slots__)
+
+    def __setstate__(self, state):
+        for (name, value) in state.iteritems():
+            setattr(self, name, value)
 
     def __hash__(self):
         return hash(self.key)
@@ -107,6 +572,20 @@ class Task(object):
     def __call__(self):
         return self.call(*self.args, **self.kwargs)
 
+    def save(self, state):
+        """Record intermediate state, replacing any saved earlier.
+
+        State saved while the worker is being interrupted, eg in a handler
+        for KeyboardInterrupt that then reraises it, is also kept.
+        """
+
+        self.checkpoint = state
+
+    def dependencies(self):
+        """Return the tasks on whose results this task depends."""
+
+        return [v for v in itertools.chain(self.args, self.kwargs.itervalues()) if isinstance(v, Task)]
+
     @staticmethod
     def from_request(request):
         """Build a task, if necessary."""
@@ -114,372 +593,3287 @@ class Task(object):
         if isinstance(request, Task):
             return request
         elif isinstance(request, collections.Mapping):
-            return Task(**mapping)
+            return Task(**request)
         else:
             return Task(*request)
 
-class TaskState(object):
-    """Current state of progress on a task."""
+def digest_task(task, memo = None, cells = True):
+    """Return a digest of a task's callable and arguments, stable across runs.
 
-    def __init__(self, task):
-        self.task = task
-        self.done = False
-        self.working = set()
+    Functions are identified by qualified name. Lambdas and nested functions,
+    which can share a name, are identified also by their code and defaults
+    and, if cells, by their closed-over values; a task whose closure cannot
+    be pickled then cannot be digested. Array digests are remembered in
+    memo, if given, keyed by object id.
+    """
 
-    def score(self):
-        """Score the urgency of this task."""
+    if memo is None:
+        memo = {}
 
-        if self.done:
-            return (sys.maxint, sys.maxint, random.random())
-        if len(self.working) == 0:
-            return (0, 0, random.random())
+    def describe_code(code):
+        constants = [describe_code(c) if isinstance(c, types.CodeType) else c for c in code.co_consts]
+
+        return (code.co_code, constants, code.co_names)
+
+    def persistent_id(value):
+        if isinstance(value, types.BuiltinFunctionType):
+            return "{0}.{1}".format(value.__module__, value.__name__)
+        elif isinstance(value, types.FunctionType):
+            name = "{0}.{1}".format(value.__module__, value.__name__)
+
+            if getattr(sys.modules.get(value.__module__), value.__name__, None) is value:
+                return name
+            elif cells:
+                contents = [cell.cell_contents for cell in value.func_closure or []]
+
+                return (name, describe_code(value.func_code), value.func_defaults, contents)
+            else:
+                return (name, describe_code(value.func_code), value.func_defaults)
+        elif isinstance(value, Task):
+            # a dependency, identified by its content rather than its key
+            return digest_task(value, memo, cells)
+        elif isinstance(value, numpy.ndarray) and not value.dtype.hasobject:
+            known = memo.get(id(value))
+
+            if known is None:
+                contiguous = numpy.ascontiguousarray(value)
+                digest = \
+                    cargo.io.hash_yielded_bytes([
+                        str(contiguous.dtype),
+                        str(contiguous.shape),
+                        buffer(contiguous),
+                        ])
+                known = memo[id(value)] = (value, digest)
+
+            return known[1]
         else:
-            return (
-                len(self.working),
-                max(wstate.timestamp for wstate in self.working),
-                random.random(),
-                )
+            return None
 
-class WorkerState(object):
-    """Current state of a known worker process."""
+    pickled_file = StringIO.StringIO()
+    pickler = pickle.Pickler(pickled_file, pickle.HIGHEST_PROTOCOL)
 
-    def __init__(self, condor_id):
-        self.condor_id = condor_id
-        self.assigned = None
-        self.timestamp = None
+    pickler.persistent_id = persistent_id
 
-    def set_done(self):
-        self.assigned.working.remove(self)
+    pickler.dump((task.call, task.args, task.kwargs))
 
-        was_done = self.assigned.done
+    return cargo.io.hash_bytes(pickled_file.getvalue())
 
-        self.assigned.done = True
-        self.assigned = None
+def get_task_family(task):
+    """Return the name of the family to which a task belongs."""
 
-        return was_done
+    call = task.call
 
-    def set_assigned(self, tstate):
-        """Change worker state in response to assignment."""
+    if isinstance(call, (types.FunctionType, types.BuiltinFunctionType)):
+        return "{0}.{1}".format(call.__module__, call.__name__)
+    else:
+        return "{0}.{1}".format(type(call).__module__, type(call).__name__)
 
-        self.disassociate()
+class CostModel(object):
+    """Learn the expected run time of each family of tasks.
 
-        self.assigned = tstate
-        self.timestamp = time.time()
+    Estimates are exponential moving averages of observed durations. Until
+    a family has been observed, its tasks are presumed long, so that it is
+    sampled early. An estimate is republished, and the family's
+    queued tasks reprioritized, only when it moves by more than some ratio.
+    """
 
-        self.assigned.working.add(self)
+    def __init__(self, smoothing = 0.25, ratio = 2.0):
+        """Initialize."""
 
-    def set_interruption(self):
-        """Change worker state in response to interruption."""
+        self.smoothing = smoothing
+        self.ratio = ratio
+        self.averages = {}
+        self.published = {}
 
-        self.disassociate()
+    def estimate(self, task):
+        """Return the expected cost of a task."""
 
-    def set_error(self):
-        """Change worker state in response to error."""
+        if task.cost is not None:
+            return task.cost
+        else:
+            return self.published.get(get_task_family(task), float("inf"))
 
-        self.disassociate()
+    def observe(self, task, seconds):
+        """Record a task duration; return the family if its estimate changed."""
 
-    def disassociate(self):
-        """Disassociate from the current job."""
+        family = get_task_family(task)
+        average = self.averages.get(family)
 
-        if self.assigned is not None:
-            self.assigned.working.remove(self)
+        if average is None:
+            average = seconds
+        else:
+            average += self.smoothing * (seconds - average)
 
-            self.assigned = None
+        self.averages[family] = average
 
-class ManagerCore(object):
-    """Maintain the task queue and worker assignments."""
+        published = self.published.get(family)
 
-    def __init__(self, task_list):
-        """Initialize."""
+        if published is None or not published / self.ratio <= average <= published * self.ratio:
+            self.published[family] = average
 
-        self.tstates = dict((t.key, TaskState(t)) for t in task_list)
-        self.wstates = {}
+            return family
+        else:
+            return None
 
-    def handle(self, message):
-        """Manage workers and tasks."""
+def assign_stable_keys(tasks):
+    """Replace default (id-based) task keys with content-derived keys.
 
-        logger.info(
-            "[%s/%i] %s",
-            str(self.done_count()).rjust(len(str(len(self.tstates))), "0"),
-            len(self.tstates),
-            message.get_summary(),
-            )
+    Identical tasks are distinguished by their order of appearance, as are
+    closures that differ only in their closed-over values, which may change
+    from run to run. Raises ValueError for a task that cannot be digested.
+    """
 
-        sender = self.wstates.get(message.sender)
+    for _ in iassign_stable_keys(tasks):
+        pass
 
-        if sender is None:
-            sender = WorkerState(message.sender)
+def iassign_stable_keys(tasks):
+    """Yield tasks, lazily assigning them stable keys; see assign_stable_keys()."""
 
-            self.wstates[sender.condor_id] = sender
+    memo = {}
+    seen = collections.defaultdict(int)
 
-        if isinstance(message, ApplyMessage):
-            # task request
-            sender.disassociate()
-            sender.set_assigned(self.next_task())
+    for task in tasks:
+        if task.key == id(task):
+            try:
+                digest = digest_task(task, memo, cells = False)
+            except (pickle.PicklingError, TypeError), error:
+                raise ValueError("cannot derive a stable key for task {0!r}: {1}".format(task.call, error))
 
-            return (sender.assigned.task, None)
-        elif isinstance(message, DoneMessage):
-            # task result
-            finished = sender.assigned
-            was_done = sender.set_done()
+            task.key = (digest, seen[digest])
 
-            assert finished.task.key == message.key
+            seen[digest] += 1
 
-            selected = self.next_task()
+        yield task
 
-            if selected is None:
-                selected_task = None
-            else:
-                selected_task = selected.task
+class ResultJournal(object):
+    """Append-only, crash-tolerant record of completed task results.
 
-                sender.set_assigned(selected)
+    Records are length-prefixed pickles of (key, result) pairs; a truncated
+    final record, left by a crash mid-write, is ignored and overwritten.
+    """
 
-            if was_done:
-                return (selected_task, None)
-            else:
-                return (selected_task, (finished.task, message.result))
-        elif isinstance(message, InterruptedMessage):
-            # worker interruption
-            sender.set_interruption()
+    header = struct.Struct("!I")
 
-            return (None, None)
-        elif isinstance(message, ErrorMessage):
-            # worker exception
-            sender.set_error()
+    def __init__(self, path, sync = False):
+        """Initialize."""
 
-            return (None, None)
-        else:
-            raise TypeError("unrecognized message type")
+        self.path = path
+        self.sync = sync
+        self.journal_file = None
 
-    def next_task(self):
-        """Select the next task on which to work."""
+    def load(self):
+        """Return the recorded results, as a dictionary keyed by task key."""
 
-        tstate = min(self.tstates.itervalues(), key = TaskState.score)
+        results = {}
+        valid = 0
 
-        if tstate.done:
-            return None
-        else:
-            return tstate
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as journal_file:
+                while True:
+                    header = journal_file.read(self.header.size)
 
-    def done_count(self):
-        """Return the number of completed tasks."""
+                    if len(header) < self.header.size:
+                        break
 
-        return sum(1 for t in self.tstates.itervalues() if t.done)
+                    (length,) = self.header.unpack(header)
+                    pickled = journal_file.read(length)
 
-    def unfinished_count(self):
-        """Return the number of unfinished tasks."""
+                    if len(pickled) < length:
+                        break
 
-        return sum(1 for t in self.tstates.itervalues() if not t.done)
+                    (key, result) = pickle.loads(pickled)
 
-class RemoteManager(object):
-    """Manage remotely-distributed work."""
+                    results[key] = result
+                    valid = journal_file.tell()
 
-    def __init__(self, task_list, handler, rep_socket):
-        """Initialize."""
+            with open(self.path, "r+b") as journal_file:
+                journal_file.truncate(valid)
 
-        self.handler = handler
-        self.rep_socket = rep_socket
-        self.core = ManagerCore(task_list)
+        logger.info("loaded %i results from journal %s", len(results), self.path)
 
-    def manage(self):
-        """Manage workers and tasks."""
+        return results
 
-        import zmq
+    def record(self, key, result):
+        """Append a completed result."""
 
-        poller = zmq.Poller()
+        if self.journal_file is None:
+            self.journal_file = open(self.path, "ab")
 
-        poller.register(self.rep_socket, zmq.POLLIN)
+        pickled = pickle.dumps((key, result), pickle.HIGHEST_PROTOCOL)
 
-        while self.core.unfinished_count() > 0:
-            events = dict(poller.poll())
+        self.journal_file.write(self.header.pack(len(pickled)))
+        self.journal_file.write(pickled)
+        self.journal_file.flush()
 
-            assert events.get(self.rep_socket) == zmq.POLLIN
+        if self.sync:
+            os.fsync(self.journal_file.fileno())
 
-            message = recv_pyobj_gz(self.rep_socket)
+    def close(self):
+        """Close the journal file, if open."""
 
-            (response, completed) = self.core.handle(message)
+        if self.journal_file is not None:
+            self.journal_file.close()
 
-            send_pyobj_gz(self.rep_socket, response)
+            self.journal_file = None
 
-            if completed is not None:
-                self.handler(*completed)
+class ResultCache(object):
+    """Persistent, size-bounded store of task results, keyed by content.
 
-    @staticmethod
-    def distribute(tasks, workers = 8, handler = lambda _, x: x):
-        """Distribute computation to remote workers."""
+    A task is identified by a digest of its callable's qualified name and
+    its arguments (see digest_task), so results survive across runs; a
+    changed implementation under the same name is not detected. Each result
+    is a pickle in its own file; the least-recently-used are evicted once
+    the store exceeds capacity bytes.
+    """
 
-        import zmq
+    def __init__(self, path, capacity = 2**30):
+        """Initialize."""
 
-        logger.info("distributing %i tasks to %i workers", len(tasks), workers)
+        self.path = path
+        self.capacity = capacity
+        self.index = None
+        self.size = 0
+        self.memo = {}
 
-        # prepare zeromq
-        context = zmq.Context()
-        rep_socket = context.socket(zmq.REP)
-        rep_port = rep_socket.bind_to_random_port("tcp://*")
+    def load(self):
+        """Index the store, if not yet indexed."""
 
-        logger.debug("listening on port %i", rep_port)
+        if self.index is not None:
+            return
 
-        # launch condor jobs
-        cluster = cargo.submit_condor_workers(workers, "tcp://%s:%i" % (socket.getfqdn(), rep_port))
+        self.index = {}
 
-        try:
-            try:
-                return RemoteManager(tasks, handler, rep_socket).manage()
-            except KeyboardInterrupt:
-                # work around bizarre pyzmq SIGINT behavior
-                raise
-        finally:
-            # clean up condor jobs
-            cargo.condor_rm(cluster)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
 
-            logger.info("removed condor jobs")
+        for name in os.listdir(self.path):
+            if name.endswith(".pickle"):
+                stat = os.stat(os.path.join(self.path, name))
 
-            # clean up zeromq
-            rep_socket.close()
-            context.term()
+                self.index[name] = (stat.st_mtime, stat.st_size)
+                self.size += stat.st_size
 
-            logger.info("terminated zeromq context")
+        logger.info("indexed %i cached results (%i bytes) in %s", len(self.index), self.size, self.path)
 
-class LocalWorkerProcess(multiprocessing.Process):
-    """Work in a subprocess."""
+    def name(self, task):
+        """Return the file name under which a task's result is stored, or None."""
 
-    def __init__(self, stm_queue):
-        """Initialize."""
+        try:
+            (algorithm, digest) = digest_task(task, self.memo)
+        except (pickle.PicklingError, TypeError):
+            return None
+        else:
+            return "{0}-{1}.pickle".format(algorithm, digest.encode("hex"))
 
-        multiprocessing.Process.__init__(self)
+    def lookup(self, name):
+        """Return (True, result) for a stored result, or (False, None)."""
 
-        self.stm_queue = stm_queue
-        self.mts_queue = multiprocessing.Queue()
+        self.load()
 
-    def run(self):
-        """Work."""
+        if name not in self.index:
+            return (False, None)
 
-        class DeathRequestedError(Exception):
-            pass
+        path = os.path.join(self.path, name)
 
         try:
-            def handle_sigusr1(number, frame):
-                raise DeathRequestedError()
+            with open(path, "rb") as result_file:
+                result = pickle.load(result_file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            logger.warning("ignoring unreadable cached result %s", path)
 
-            signal.signal(signal.SIGUSR1, handle_sigusr1)
+            return (False, None)
 
-            logger.info("subprocess running")
+        # mark the entry as recently used
+        now = time.time()
+        (_, size) = self.index[name]
 
-            task = None
+        os.utime(path, (now, now))
 
-            while True:
-                # get an assignment
-                if task is None:
-                    self.stm_queue.put(ApplyMessage(os.getpid()))
+        self.index[name] = (now, size)
 
-                    task = self.mts_queue.get()
+        return (True, result)
 
-                    if task is None:
-                        logger.info("received null assignment; terminating")
+    def store(self, name, result):
+        """Store a result, evicting old entries if necessary."""
 
-                        return None
+        self.load()
 
-                # complete the assignment
-                try:
-                    seed = abs(hash(task.key))
+        pickled = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        (fd, temporary_path) = tempfile.mkstemp(prefix = ".", dir = self.path)
 
-                    logger.info("setting PRNG seed to %s", seed)
+        with os.fdopen(fd, "wb") as temporary_file:
+            temporary_file.write(pickled)
 
-                    numpy.random.seed(seed)
-                    random.seed(numpy.random.randint(2**32))
+        os.rename(temporary_path, os.path.join(self.path, name))
 
-                    logger.info("starting work on task %s", task.key)
+        previous = self.index.get(name)
 
-                    result = task()
-                except KeyboardInterrupt, error:
-                    logger.warning("interruption during task %s", task.key)
+        if previous is not None:
+            self.size -= previous[1]
 
-                    self.stm_queue.put(InterruptedMessage(os.getpid(), task.key))
-                    self.mts_queue.get()
+        self.index[name] = (time.time(), len(pickled))
+        self.size += len(pickled)
 
-                    break
-                except DeathRequestedError:
-                    logger.warning("death requested; terminating")
+        if self.size > self.capacity:
+            self.evict()
 
-                    break
-                except BaseException, error:
-                    description = traceback.format_exc(error)
+    def evict(self):
+        """Remove least-recently-used entries, leaving some slack below capacity."""
 
-                    logger.warning("error during task %s:\n%s", task.key, description)
+        target = 0.9 * self.capacity
 
-                    self.stm_queue.put(ErrorMessage(os.getpid(), task.key, description))
-                    self.mts_queue.get()
+        for (_, name) in sorted((used, name) for (name, (used, _)) in self.index.iteritems()):
+            if self.size <= target:
+                break
 
-                    break
-                else:
-                    logger.info("finished task %s", task.key)
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
 
-                    self.stm_queue.put(DoneMessage(os.getpid(), task.key, result))
+            (_, size) = self.index.pop(name)
 
-                    task = self.mts_queue.get()
+            self.size -= size
+
+        logger.info("evicted cached results down to %i bytes", self.size)
+
+class SharedArgument(object):
+    """Reference, by content digest, to a large task argument.
+
+    The value itself is attached only when the receiving worker is not known
+    to hold it already.
+    """
+
+    def __init__(self, digest, size, value = None):
+        self.digest = digest
+        self.size = size
+        self.value = value
+
+class SharedArgumentIndex(object):
+    """Replace large task arguments with references, on the manager side.
+
+    Digests are remembered by object id, alongside the object itself, so
+    that the id cannot be recycled; an object is dropped once every task
+    prepared with it has been released.
+    """
+
+    def __init__(self, threshold = 2**16):
+        """Initialize."""
+
+        self.threshold = threshold
+        self.by_id = {}
+        self.ids = collections.defaultdict(set)
+        self.users = collections.defaultdict(set)
+        self.held = {}
+
+    def share(self, value):
+        """Return a reference to a large value, or None for a small one."""
+
+        known = self.by_id.get(id(value))
+
+        if known is not None:
+            return known[1]
+
+        if isinstance(value, numpy.ndarray) and not value.dtype.hasobject:
+            size = value.nbytes
+
+            if size < self.threshold:
+                return None
+
+            contiguous = numpy.ascontiguousarray(value)
+            digest = \
+                cargo.io.hash_yielded_bytes([
+                    str(contiguous.dtype),
+                    str(contiguous.shape),
+                    buffer(contiguous),
+                    ])
+        else:
+            if isinstance(value, (bool, int, long, float, type(None))):
+                return None
+
+            pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            size = len(pickled)
+
+            if size < self.threshold:
+                return None
+
+            digest = cargo.io.hash_bytes(pickled)
+
+        reference = SharedArgument(digest, size)
+
+        self.by_id[id(value)] = (value, reference)
+        self.ids[digest].add(id(value))
+
+        return reference
+
+    def prepare(self, tasks, cached):
+        """Return copies of tasks to send to a worker holding cached digests."""
+
+        sent = set(cached)
+        used = set()
+
+        def substitute(value):
+            reference = self.share(value)
+
+            if reference is None:
+                return value
+
+            used.add(reference.digest)
+
+            if reference.digest in sent:
+                return reference
+            else:
+                sent.add(reference.digest)
+
+                return SharedArgument(reference.digest, reference.size, value)
+
+        prepared = []
+
+        for task in tasks:
+            wire = copy.copy(task)
+
+            wire.args = map(substitute, task.args)
+            wire.kwargs = dict((k, substitute(v)) for (k, v) in task.kwargs.iteritems())
+
+            prepared.append(wire)
+
+            if used:
+                self.held.setdefault(task.key, set()).update(used)
+
+                for digest in used:
+                    self.users[digest].add(task.key)
+
+                used.clear()
+
+        return prepared
+
+    def release(self, key):
+        """Note that a task is finished; drop values no other task needs."""
+
+        for digest in self.held.pop(key, ()):
+            users = self.users[digest]
+
+            users.discard(key)
+
+            if not users:
+                del self.users[digest]
+
+                for value_id in self.ids.pop(digest):
+                    del self.by_id[value_id]
+
+class SharedArgumentCache(object):
+    """Bounded LRU cache of shared arguments, on the worker side.
+
+    Digests advertised to the manager in a still-unanswered request are
+    pinned, since the reply may refer to them without attaching values.
+    """
+
+    def __init__(self, capacity = 2**28):
+        """Initialize."""
+
+        self.capacity = capacity
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.pins = collections.defaultdict(int)
+
+    def advertise(self):
+        """Pin and return the cached digests, to accompany a request."""
+
+        digests = self.entries.keys()
+
+        for digest in digests:
+            self.pins[digest] += 1
+
+        return digests
+
+    def release(self, digests):
+        """Unpin digests advertised with a request that has been answered."""
+
+        for digest in digests:
+            self.pins[digest] -= 1
+
+            if self.pins[digest] == 0:
+                del self.pins[digest]
+
+        self.evict()
+
+    def resolve(self, tasks):
+        """Replace references in a received assignment with their values."""
+
+        def lookup(value):
+            if not isinstance(value, SharedArgument):
+                return value
+            elif value.value is None:
+                (found, size) = self.entries.pop(value.digest)
+
+                self.entries[value.digest] = (found, size)
+
+                return found
+            else:
+                previous = self.entries.pop(value.digest, None)
+
+                if previous is not None:
+                    self.size -= previous[1]
+
+                self.entries[value.digest] = (value.value, value.size)
+                self.size += value.size
+
+                return value.value
+
+        for task in tasks:
+            task.args = map(lookup, task.args)
+            task.kwargs = dict((k, lookup(v)) for (k, v) in task.kwargs.iteritems())
+
+        self.evict()
+
+        return tasks
+
+    def evict(self):
+        """Drop least-recently-used unpinned entries while over capacity."""
+
+        if self.size > self.capacity:
+            for digest in self.entries.keys():
+                if self.size <= self.capacity:
+                    break
+                elif digest not in self.pins:
+                    (_, size) = self.entries.pop(digest)
+
+                    self.size -= size
+
+def get_shared_memory_root():
+    """Return the directory in which to create shared-memory segments."""
+
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    else:
+        return tempfile.gettempdir()
+
+class SharedMemoryCodec(object):
+    """Pass objects between local processes, moving large arrays through shared memory.
+
+    Contiguous numpy arrays of at least threshold bytes, wherever they appear
+    in an object, are written to memory-mapped files under a per-run
+    directory (on tmpfs, where available); the encoded object is a small
+    pickle that names those segments. With persistent=True, a segment is
+    reused for the same array object while any owner passed to encode()
+    still holds it, and is unlinked by release() once none does; it is
+    mapped copy-on-write by each decode(), so that a task may change its
+    arguments in place without affecting any other. Otherwise the decoding
+    side unlinks each segment after mapping it.
+    """
+
+    def __init__(self, directory, threshold = 2**16, persistent = False):
+        """Initialize."""
+
+        self.directory = directory
+        self.threshold = threshold
+        self.persistent = persistent
+        self.serials = itertools.count()
+        self.written = {}
+        self.users = {}
+        self.held = {}
+
+    def encode(self, value, owner = None):
+        """Return a string encoding value, its segments held by owner."""
+
+        paths = self.held.setdefault(owner, set()) if self.persistent else None
+
+        def persistent_id(value):
+            if isinstance(value, numpy.ndarray) \
+                and value.nbytes >= self.threshold \
+                and not value.dtype.hasobject:
+                descriptor = self.write(value)
+
+                if paths is not None:
+                    paths.add(descriptor[0])
+                    self.users[descriptor[0]][1].add(owner)
+
+                return descriptor
+            else:
+                return None
+
+        pickled_file = StringIO.StringIO()
+        pickler = pickle.Pickler(pickled_file, pickle.HIGHEST_PROTOCOL)
+
+        pickler.inst_persistent_id = persistent_id
+
+        pickler.dump(value)
+
+        return pickled_file.getvalue()
+
+    def write(self, array):
+        """Copy an array into a new segment; return its descriptor."""
+
+        if self.persistent:
+            known = self.written.get(id(array))
+
+            if known is not None:
+                return known[1]
+
+        # never reuse a name, so that a reader cannot confuse segments
+        prefix = "array.%i." % self.serials.next()
+        (fd, path) = tempfile.mkstemp(prefix = prefix, dir = self.directory)
+
+        os.close(fd)
+
+        segment = numpy.memmap(path, array.dtype, "w+", shape = array.shape)
+
+        segment[...] = array
+
+        del segment
+
+        descriptor = (path, array.dtype, array.shape)
+
+        if self.persistent:
+            # hold the array, so that its id is not recycled while in use
+            self.written[id(array)] = (array, descriptor)
+            self.users[path] = (id(array), set())
+
+        return descriptor
+
+    def release(self, owner):
+        """Release the segments held by owner, unlinking those no longer held."""
+
+        for path in self.held.pop(owner, ()):
+            (key, users) = self.users[path]
+
+            users.discard(owner)
+
+            if not users:
+                del self.users[path]
+                del self.written[key]
+
+                os.unlink(path)
+
+    def decode(self, encoded):
+        """Return the object encoded by a string."""
+
+        unpickler = pickle.Unpickler(StringIO.StringIO(encoded))
+        mapped = {}
+
+        def persistent_load(descriptor):
+            # an array named twice in one object is mapped once
+            array = mapped.get(descriptor[0])
+
+            if array is None:
+                array = mapped[descriptor[0]] = self.read(descriptor)
+
+            return array
+
+        unpickler.persistent_load = persistent_load
+
+        return unpickler.load()
+
+    def read(self, (path, dtype, shape)):
+        """Map the array stored in a segment."""
+
+        if self.persistent:
+            return numpy.memmap(path, dtype, "c", shape = shape).view(numpy.ndarray)
+        else:
+            array = numpy.memmap(path, dtype, "r+", shape = shape).view(numpy.ndarray)
+
+            os.unlink(path)
+
+            return array
+
+class TaskState(object):
+    """Current state of progress on a task.
+
+    Until a task is first assigned, it shares a single empty mapping of
+    workers, rather than holding its own.
+    """
+
+    __slots__ = [
+        "task",
+        "prepared",
+        "cost",
+        "queued",
+        "sequence",
+        "done",
+        "working",
+        "waiting",
+        "dependents",
+        "checkpoint",
+        ]
+
+    unassigned = {}
+
+    def __init__(self, task, cost = 0.0, queued = None, sequence = 0):
+        self.task = task
+        self.prepared = task
+        self.cost = cost
+        self.queued = queued
+        self.sequence = sequence
+        self.done = False
+        self.working = TaskState.unassigned
+        self.waiting = 0
+        self.dependents = None
+        self.checkpoint = None
+
+    def score(self):
+        """Score the urgency of this task."""
+
+        if self.done:
+            return (sys.maxint, sys.maxint, 0, 0.0, random.random())
+        if len(self.working) == 0:
+            return (0, 0, -self.task.priority, -self.cost, self.sequence)
+        else:
+            started = self.started()
+
+            if started is None:
+                # copies yet to start cannot straggle, so sort them last
+                started = float("inf")
+
+            return (
+                len(self.working),
+                started,
+                -self.task.priority,
+                -self.cost,
+                random.random(),
+                )
+
+    def started(self):
+        """Return when the newest copy started, or None if any copy has yet to start."""
+
+        started = None
+
+        for value in self.working.itervalues():
+            if value is None:
+                return None
+            else:
+                started = max(started, value)
+
+        return started
+
+class WorkerState(object):
+    """Current state of a known worker process."""
+
+    __slots__ = ["condor_id", "leased", "seen", "beating"]
+
+    def __init__(self, condor_id):
+        self.condor_id = condor_id
+        self.leased = {}
+        self.seen = time.time()
+        self.beating = False
+
+    def set_done(self, tstate):
+        """Change worker state in response to completion."""
+
+        self.release(tstate)
+
+        was_done = tstate.done
+
+        tstate.done = True
+
+        return was_done
+
+    def set_assigned(self, tstate):
+        """Change worker state in response to assignment.
+
+        A worker that sends heartbeats may queue its tasks, so each is taken
+        to start only once a heartbeat says so; otherwise, on assignment.
+        """
+
+        self.leased[tstate.task.key] = tstate
+
+        if tstate.working is TaskState.unassigned:
+            tstate.working = {}
+
+        if self.beating:
+            tstate.working[self] = None
+        else:
+            tstate.working[self] = time.time()
+
+    def set_interruption(self):
+        """Change worker state in response to interruption."""
+
+        return self.disassociate()
+
+    def set_error(self):
+        """Change worker state in response to error."""
+
+        return self.disassociate()
+
+    def release(self, tstate):
+        """Give up the lease on a single task, if held."""
+
+        if self.leased.pop(tstate.task.key, None) is not None:
+            del tstate.working[self]
+
+    def disassociate(self):
+        """Disassociate from every leased task; return those tasks."""
+
+        released = self.leased.values()
+
+        for tstate in released:
+            del tstate.working[self]
+
+        self.leased.clear()
+
+        return released
+
+class Speculator(object):
+    """Decide when a running task is a straggler worth duplicating.
+
+    A task is due for speculative re-execution once its newest copy has run
+    for longer than some multiple of a high quantile of observed durations;
+    a task with a copy not yet started is never due.
+    """
+
+    def __init__(self, quantile = 0.9, multiplier = 1.5, minimum = 1.0, samples = 256):
+        """Initialize."""
+
+        self.quantile = quantile
+        self.multiplier = multiplier
+        self.minimum = minimum
+        self.durations = collections.deque(maxlen = samples)
+        self.threshold = None
+        self.stale = 0
+
+    def observe(self, seconds):
+        """Record the duration of one completed task."""
+
+        self.durations.append(seconds)
+
+        self.stale += 1
+
+        if self.threshold is None or self.stale >= 16:
+            quantile = numpy.percentile(self.durations, 100.0 * self.quantile)
+
+            self.threshold = max(self.minimum, self.multiplier * quantile)
+            self.stale = 0
+
+    def due(self, started, now):
+        """Is a copy started at this time (or None, if unstarted) now a straggler?"""
+
+        return self.threshold is not None and started is not None and now - started > self.threshold
+
+class TaskQueue(object):
+    """Priority queue of unfinished tasks, ordered by urgency.
+
+    Entries are invalidated lazily: reprioritizing a task pushes a fresh heap
+    entry and marks the old one stale, so each operation is O(log N).
+    """
+
+    def __init__(self, tstates = []):
+        """Initialize."""
+
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+        for tstate in tstates:
+            self._entries[tstate.task.key] = [tstate.score(), self._counter.next(), tstate]
+
+        self._heap = self._entries.values()
+
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def update(self, tstate):
+        """Insert a task, or reprioritize one already present."""
+
+        self.remove(tstate)
+
+        entry = [tstate.score(), self._counter.next(), tstate]
+
+        self._entries[tstate.task.key] = entry
+
+        heapq.heappush(self._heap, entry)
+
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._compact()
+
+    def remove(self, tstate):
+        """Remove a task, if present."""
+
+        entry = self._entries.pop(tstate.task.key, None)
+
+        if entry is not None:
+            entry[-1] = None
+
+    def peek(self):
+        """Return the most urgent task, or None if the queue is empty."""
+
+        heap = self._heap
+
+        while heap and heap[0][-1] is None:
+            heapq.heappop(heap)
+
+        if heap:
+            return heap[0][-1]
+        else:
+            return None
+
+    def _compact(self):
+        """Drop stale entries from the heap."""
+
+        self._heap = [entry for entry in self._heap if entry[-1] is not None]
+
+        heapq.heapify(self._heap)
+
+class ManagerCore(object):
+    """Maintain the task queue and worker assignments.
+
+    Workers that have sent heartbeats are presumed dead, and their leases
+    released, once silent for timeout seconds. With a speculator, running
+    tasks are duplicated only once they straggle; until then, requests that
+    cannot be served are parked (signalled by a None response) and answered
+    later through wake(). Unstarted tasks are served longest-expected-first,
+    by their own cost estimates or those of a cost model. While hold, if
+    given, returns true, no task is leased, and requests are parked rather
+    than served, so that a slow consumer of results can apply backpressure.
+
+    Tasks may come from any iterable. Given a window, tasks are pulled from
+    it only while fewer than window tasks are unfinished, so that a lazy
+    source is never materialized. Completed tasks are forgotten.
+
+    Dependencies of admitted tasks are admitted with them; a dependent is
+    queued once its last dependency completes. Results are held only for
+    dependents already admitted, so those from a lazy source should follow
+    their dependencies closely, or the dependencies will be rerun; results
+    computed elsewhere, eg replayed from a journal, may be supplied in known,
+    keyed by task key.
+
+    Completing a member of a task group cancels its other members, and their
+    dependents; cancelled tasks are never passed on as completed. Workers
+    running a cancelled task are listed by cancellations(), so that they can
+    be told to abandon it. A worker leases at most one member of a group at
+    a time. Members of a group should be admitted together; one admitted
+    after its group was decided starts a new race.
+
+    Scheduling is instrumented through metrics, whose summary is logged as a
+    line of JSON every report_interval seconds and at the end of the run.
+
+    Bookkeeping costs roughly 750 bytes per unfinished task, including the
+    slotted Task itself but not its arguments, on 64-bit CPython 2.7; a task
+    is released once complete, so only admitted and unfinished tasks count.
+    The large arguments that RemoteManager and LocalManager hold for a task
+    are released with it. Measure both with the --memory mode of
+    cargo.tools.labor.benchmark.
+    """
+
+    def __init__(
+        self,
+        task_list,
+        timeout = None,
+        speculator = None,
+        costs = None,
+        metrics = None,
+        report_interval = 60.0,
+        hold = None,
+        window = None,
+        known = None,
+        ):
+        """Initialize."""
+
+        if costs is None:
+            costs = CostModel()
+        if metrics is None:
+            metrics = Metrics()
+
+        now = time.time()
+
+        self.costs = costs
+        self.metrics = metrics
+        self.report_interval = report_interval
+        self.next_report = now + report_interval
+        self.tstates = {}
+        self.families = collections.defaultdict(set)
+        self.wstates = {}
+        self.queue = TaskQueue()
+        self.ntasks = 0
+        self.ndone = 0
+        self.nunstarted = 0
+        self.timeout = timeout
+        self.speculator = speculator
+        self.parked = collections.OrderedDict()
+        self.next_expiry = 0.0
+        self.hold = hold
+        self.window = window
+        self.source = iter(task_list)
+        self.results = {}
+        self.known = known
+        self.sequence = itertools.count()
+        self.groups = {}
+        self.cancelled = []
+
+        self.admit()
+
+    def handle(self, message):
+        """Manage workers and tasks."""
+
+        now = time.time()
+
+        if logger.isEnabledFor(logging.DEBUG) and not isinstance(message, HeartbeatMessage):
+            logger.debug(
+                "[%s/%i] %s",
+                str(self.ndone).rjust(len(str(self.ntasks)), "0"),
+                self.ntasks,
+                message.get_summary(),
+                )
+
+        sender = self.wstates.get(message.sender)
+
+        if sender is None:
+            sender = WorkerState(message.sender)
+
+            self.wstates[sender.condor_id] = sender
+
+        sender.seen = now
+
+        handled = self.dispatch(sender, message, now)
+
+        self.metrics.count("manager.messages")
+        self.metrics.observe("manager.handle_seconds", time.time() - now)
+
+        return handled
+
+    def dispatch(self, sender, message, now):
+        """Respond to a message from a known worker."""
+
+        if isinstance(message, ApplyMessage):
+            # task request
+            self.requeue(sender.disassociate())
+
+            return (self.lease_or_park(sender, message.count, now), [])
+        elif isinstance(message, DoneMessage):
+            # task result
+            completed = self.complete(sender, message, now)
+
+            return (self.lease_or_park(sender, 1, now), completed)
+        elif isinstance(message, BatchMessage):
+            # several task results
+            completed = []
+
+            if message.partial is not None and not self.accepts(message.messages):
+                # the aggregate covers a task completed elsewhere, and cannot
+                # be taken apart; drop it, and run its other tasks again
+                self.metrics.count("tasks.rejected", len(message.messages))
+
+                for done in message.messages:
+                    tstate = sender.leased.get(done.key)
+
+                    if tstate is not None:
+                        sender.release(tstate)
+                        self.requeue([tstate])
+            else:
+                for done in message.messages:
+                    completed.extend(self.complete(sender, done, now))
+
+                if message.partial is not None and completed:
+                    completed = [(completed[0][0], message.partial)]
+
+            return (self.lease_or_park(sender, message.count, now), completed)
+        elif isinstance(message, HeartbeatMessage):
+            # worker liveness
+            if not sender.beating:
+                sender.beating = True
+
+                # until now, its queued tasks were presumed started
+                for tstate in sender.leased.itervalues():
+                    if not tstate.done:
+                        tstate.working[sender] = None
+
+                        self.queue.update(tstate)
+
+            tstate = sender.leased.get(message.key)
+
+            if tstate is not None and not tstate.done and message.elapsed is not None:
+                tstate.working[sender] = now - message.elapsed
+
+                self.queue.update(tstate)
+
+            return ([], [])
+        elif isinstance(message, InterruptedMessage):
+            # worker interruption
+            for (key, checkpoint) in message.checkpoints.iteritems():
+                tstate = sender.leased.get(key)
+
+                if tstate is not None and checkpoint is not None:
+                    tstate.checkpoint = checkpoint
+
+                    self.metrics.count("tasks.checkpointed")
+
+            self.parked.pop(sender.condor_id, None)
+            self.requeue(sender.set_interruption())
+
+            return ([], [])
+        elif isinstance(message, ErrorMessage):
+            # worker exception
+            self.parked.pop(sender.condor_id, None)
+            self.requeue(sender.set_error())
+
+            return ([], [])
+        else:
+            raise TypeError("unrecognized message type")
+
+    def lease(self, wstate, count, now):
+        """Assign up to count tasks to a worker; return those tasks."""
+
+        tasks = []
+
+        if self.held():
+            return tasks
+
+        while len(tasks) < count:
+            tstate = self.next_task()
+
+            if tstate is None or wstate in tstate.working:
+                break
+
+            if tstate.task.group is not None and self.racing(wstate, tstate):
+                # a worker runs one member of a group at a time
+                break
+
+            if tstate.working:
+                if self.speculator is not None:
+                    if not self.speculator.due(tstate.started(), now):
+                        break
+
+                self.metrics.count("tasks.duplicated")
+            else:
+                self.metrics.observe("task.wait_seconds", now - tstate.queued)
+
+                self.nunstarted -= 1
+
+            wstate.set_assigned(tstate)
+
+            self.queue.update(tstate)
+
+            if tstate.checkpoint is None:
+                tasks.append(tstate.prepared)
+            else:
+                resumed = copy.copy(tstate.prepared)
+
+                resumed.checkpoint = tstate.checkpoint
+
+                tasks.append(resumed)
+
+        return tasks
+
+    def racing(self, wstate, tstate):
+        """Is a worker already leasing another member of a task's group?"""
+
+        for member in self.groups.get(tstate.task.group, []):
+            if member is not tstate and member.task.key in wstate.leased:
+                return True
+
+        return False
+
+    def lease_or_park(self, wstate, count, now):
+        """Assign tasks to a worker, or park its request; return tasks or None."""
+
+        tasks = self.lease(wstate, count, now)
+
+        if tasks or count == 0 or self.unfinished_count() == 0:
+            return tasks
+        elif self.speculator is None and not self.held():
+            return tasks
+        else:
+            self.parked[wstate.condor_id] = (count, now)
+
+            return None
+
+    def wake(self, now = None):
+        """Serve parked requests that can now be served; return (worker, tasks) pairs."""
+
+        if now is None:
+            now = time.time()
+
+        woken = []
+
+        for (condor_id, (count, parked)) in self.parked.iteritems():
+            tasks = self.lease(self.wstates[condor_id], count, now)
+
+            if not tasks:
+                # only a worker racing in a task group can be passed over
+                if self.groups:
+                    continue
+                else:
+                    break
+
+            self.metrics.observe("worker.idle_seconds", now - parked)
+
+            woken.append((condor_id, tasks))
+
+        for (condor_id, _) in woken:
+            del self.parked[condor_id]
+
+        return woken
+
+    def expire(self, now = None):
+        """Drop workers whose heartbeats have stopped; return their ids."""
+
+        if now is None:
+            now = time.time()
+
+        if self.timeout is None or now < self.next_expiry:
+            return []
+
+        self.next_expiry = now + self.timeout / 4.0
+
+        expired = [
+            w.condor_id
+            for w in self.wstates.itervalues()
+            if w.beating and now - w.seen > self.timeout
+            ]
+
+        for condor_id in expired:
+            logger.warning("worker %s has gone silent; releasing its tasks", condor_id)
+
+            self.drop(condor_id)
+
+        return expired
+
+    def drop(self, condor_id):
+        """Forget a worker that is presumed dead, releasing its tasks."""
+
+        wstate = self.wstates.pop(condor_id, None)
+
+        self.parked.pop(condor_id, None)
+
+        if wstate is not None:
+            self.requeue(wstate.disassociate())
+
+    def complete(self, wstate, message, now):
+        """Record a task result; return the newly-completed (task, result) pairs."""
+
+        tstate = self.tstates.get(message.key)
+
+        if tstate is None:
+            # a duplicate of a task already completed and forgotten
+            tstate = wstate.leased.get(message.key)
+
+            if tstate is None:
+                self.metrics.count("tasks.wasted")
+
+                return []
+
+        started = tstate.working.get(wstate)
+
+        if not tstate.done and not tstate.working:
+            self.nunstarted -= 1
+
+        was_done = wstate.set_done(tstate)
+
+        if message.duration is not None:
+            duration = message.duration
+        elif started is not None:
+            duration = now - started
+        else:
+            duration = None
+
+        if duration is not None:
+            self.metrics.observe("task.run_seconds", duration)
+
+            if self.speculator is not None:
+                self.speculator.observe(duration)
+
+            family = self.costs.observe(tstate.task, duration)
+
+            if family is not None:
+                self.reestimate(family)
+
+        if was_done:
+            self.metrics.count("tasks.wasted")
+
+            return []
+        else:
+            self.metrics.count("tasks.completed")
+
+            self.ndone += 1
+
+            self.queue.remove(tstate)
+            self.forget(tstate)
+
+            if tstate.dependents:
+                self.release_dependents(tstate, message.result)
+
+            if tstate.task.group is not None:
+                for member in self.groups.pop(tstate.task.group, []):
+                    if member is not tstate:
+                        self.cancel(member)
+
+            self.admit()
+
+            return [(tstate.task, message.result)]
+
+    def accepts(self, messages):
+        """Are these completions all of tasks not already completed?"""
+
+        for done in messages:
+            tstate = self.tstates.get(done.key)
+
+            if tstate is None or tstate.done:
+                return False
+
+        return True
+
+    def admit(self):
+        """Pull tasks from the source while the window has room."""
+
+        if self.source is None:
+            return
+
+        now = time.time()
+
+        while self.window is None or self.ntasks - self.ndone < self.window:
+            task = next(self.source, None)
+
+            if task is None:
+                self.source = None
+
+                break
+            else:
+                self.add(task, now)
+
+    def add(self, task, now):
+        """Admit a task, and any of its dependencies not yet admitted."""
+
+        tstate = self.tstates.get(task.key)
+
+        if tstate is not None:
+            return tstate
+
+        tstate = TaskState(task, self.costs.estimate(task), now, self.sequence.next())
+
+        self.tstates[task.key] = tstate
+        self.ntasks += 1
+
+        if task.cost is None:
+            self.families[get_task_family(task)].add(tstate)
+
+        if task.group is not None:
+            self.groups.setdefault(task.group, []).append(tstate)
+
+        for dependency in task.dependencies():
+            held = self.results.get(dependency.key)
+
+            if held is None and self.known is not None and dependency.key in self.known:
+                held = self.results[dependency.key] = [self.known[dependency.key], 0]
+
+            if held is not None:
+                held[1] += 1
+            else:
+                dstate = self.add(dependency, now)
+
+                if dstate.dependents is None:
+                    dstate.dependents = []
+
+                dstate.dependents.append(tstate)
+
+                tstate.waiting += 1
+
+        if tstate.waiting == 0:
+            self.prepare(tstate)
+
+        return tstate
+
+    def prepare(self, tstate):
+        """Queue a task whose dependencies have completed."""
+
+        task = tstate.task
+        dependencies = task.dependencies()
+
+        if dependencies:
+            def substitute(value):
+                if isinstance(value, Task):
+                    held = self.results[value.key]
+
+                    held[1] -= 1
+
+                    if held[1] == 0:
+                        del self.results[value.key]
+
+                    return held[0]
+                else:
+                    return value
+
+            tstate.prepared = copy.copy(task)
+            tstate.prepared.args = map(substitute, task.args)
+            tstate.prepared.kwargs = dict((k, substitute(v)) for (k, v) in task.kwargs.iteritems())
+
+        self.nunstarted += 1
+
+        self.queue.update(tstate)
+
+    def release_dependents(self, tstate, result):
+        """Hand a completed result to the tasks waiting on it."""
+
+        # each entry stands for one reference by a live dependent
+        dependents = [dependent for dependent in tstate.dependents if not dependent.done]
+
+        if dependents:
+            self.results[tstate.task.key] = [result, len(dependents)]
+
+        for dependent in dependents:
+            dependent.waiting -= 1
+
+            if dependent.waiting == 0:
+                self.prepare(dependent)
+
+        tstate.dependents = None
+
+    def cancel(self, tstate):
+        """Abandon an unfinished task, and its dependents."""
+
+        if tstate.done:
+            return
+
+        if tstate.waiting > 0:
+            # give up the results held for it
+            for dependency in tstate.task.dependencies():
+                held = self.results.get(dependency.key)
+
+                if held is not None:
+                    held[1] -= 1
+
+                    if held[1] == 0:
+                        del self.results[dependency.key]
+        elif not tstate.working:
+            self.nunstarted -= 1
+
+        for wstate in tstate.working.keys():
+            wstate.release(tstate)
+
+            self.cancelled.append((wstate.condor_id, tstate.task.key))
+
+        tstate.done = True
+
+        self.ndone += 1
+
+        self.metrics.count("tasks.cancelled")
+        self.queue.remove(tstate)
+        self.forget(tstate)
+
+        if tstate.task.group is not None:
+            members = self.groups.get(tstate.task.group)
+
+            if members is not None:
+                members.remove(tstate)
+
+                if not members:
+                    del self.groups[tstate.task.group]
+
+        for dependent in tstate.dependents or []:
+            self.cancel(dependent)
+
+        tstate.dependents = None
+
+    def cancellations(self):
+        """Return, and forget, the (worker, task key) pairs of abandoned work."""
+
+        (cancelled, self.cancelled) = (self.cancelled, [])
+
+        return cancelled
+
+    def forget(self, tstate):
+        """Drop the bookkeeping of a completed task."""
+
+        del self.tstates[tstate.task.key]
+
+        if tstate.task.cost is None:
+            self.families[get_task_family(tstate.task)].discard(tstate)
+
+    def reestimate(self, family):
+        """Reprioritize the unfinished tasks of a family after its estimate changed."""
+
+        for tstate in self.families[family]:
+            tstate.cost = self.costs.estimate(tstate.task)
+
+            if tstate.waiting == 0:
+                self.queue.update(tstate)
+
+    def requeue(self, tstates):
+        """Reprioritize tasks after workers gave them up."""
+
+        now = time.time()
+
+        for tstate in tstates:
+            if not tstate.done:
+                if not tstate.working:
+                    tstate.queued = now
+
+                    self.nunstarted += 1
+
+                self.metrics.count("tasks.requeued")
+                self.queue.update(tstate)
+
+    def held(self):
+        """Is dispatch paused by hold?"""
+
+        return self.hold is not None and self.hold()
+
+    def poll_interval(self):
+        """Return how long a manager may block waiting for a message."""
+
+        # a hold may be lifted at any moment, without any message arriving
+        if self.hold is not None and self.parked:
+            return 0.05
+        else:
+            return 1.0
+
+    def report(self, now = None, final = False):
+        """Log a metrics summary, if one is due."""
+
+        if now is None:
+            now = time.time()
+
+        if final or now >= self.next_report:
+            self.next_report = now + self.report_interval
+
+            logger.info(
+                "metrics%s: %s",
+                " (final)" if final else "",
+                self.metrics.dumps(done = self.ndone, total = self.ntasks, workers = len(self.wstates)),
+                )
+
+    def next_task(self):
+        """Select the next task on which to work."""
+
+        return self.queue.peek()
+
+    def done_count(self):
+        """Return the number of completed tasks."""
+
+        return self.ndone
+
+    def unfinished_count(self):
+        """Return the number of unfinished tasks."""
+
+        return self.ntasks - self.ndone
+
+    def unstarted_count(self):
+        """Return the number of tasks on which no worker is working."""
+
+        return self.nunstarted
+
+    def widest_group(self):
+        """Return the number of unfinished members in the largest task group."""
+
+        return max([len(members) for members in self.groups.itervalues()] or [0])
+
+class RemoteManager(object):
+    """Manage remotely-distributed work."""
+
+    def __init__(
+        self,
+        task_list,
+        handler,
+        zmq_socket,
+        codec = None,
+        shared = None,
+        timeout = 60.0,
+        pool = None,
+        core = None,
+        initializer = None,
+        combine = None,
+        **options
+        ):
+        """Initialize.
+
+        The socket may be REP, which strictly alternates requests and replies,
+        or ROUTER, which serves REQ and DEALER workers asynchronously, and
+        which lets idle workers wait for stragglers rather than duplicating
+        running tasks at once. Large task arguments are sent to each worker
+        once, through a shared-argument index, unless sharing is disabled by
+        passing False. Workers silent for timeout seconds are presumed dead.
+        Idle workers are released, and new ones submitted, by a worker pool,
+        if given. A core may be given to share its task queue with other
+        managers, in which case task_list is ignored; otherwise further
+        options are passed to the ManagerCore. An initializer, if given, is
+        sent to each worker to run before its first task; a combiner, if
+        given, is sent to each worker to merge the results of each batch of
+        its tasks into one PartialResult.
+        """
+
+        import zmq
+
+        self.handler = handler
+        self.zmq_socket = zmq_socket
+        self.pool = pool
+        self.initialized = set()
+
+        if initializer is None and combine is None:
+            self.setup = None
+        else:
+            self.setup = WorkerSetup(initializer, combine)
+
+        if shared is None:
+            self.shared = SharedArgumentIndex()
+        else:
+            self.shared = shared
+
+        self.routed = zmq_socket.getsockopt(zmq.TYPE) == zmq.ROUTER
+        self.parked = {}
+        self.beats = {}
+
+        if core is None:
+            if self.routed:
+                speculator = Speculator()
+            else:
+                speculator = None
+
+            core = ManagerCore(task_list, timeout = timeout, speculator = speculator, **options)
+
+        self.core = core
+
+        if codec is None:
+            codec = copy.copy(default_codec)
+
+        if codec.metrics is None:
+            codec.metrics = self.core.metrics
+
+        self.codec = codec
+
+    def manage(self):
+        """Manage workers and tasks."""
+
+        import zmq
+
+        poller = zmq.Poller()
+
+        poller.register(self.zmq_socket, zmq.POLLIN)
+
+        while self.core.unfinished_count() > 0:
+            events = dict(poller.poll(1000 * self.core.poll_interval()))
+
+            if events.get(self.zmq_socket) == zmq.POLLIN:
+                self.receive()
+
+            # release silent workers, and serve any waiting ones
+            self.maintain()
+
+            for (condor_id, tasks) in self.core.wake():
+                self.assign(condor_id, tasks)
+
+            for (condor_id, key) in self.core.cancellations():
+                self.cancel(condor_id, key)
+
+            self.core.report()
+
+        self.core.report(final = True)
+
+    def receive(self):
+        """Receive and handle one message from a worker."""
+
+        if self.routed:
+            (envelope, message) = recv_routed_pyobj_gz(self.zmq_socket, self.codec)
+        else:
+            (envelope, message) = ([], recv_pyobj_gz(self.zmq_socket, self.codec))
+
+        (response, completed) = self.core.handle(message)
+
+        if self.routed and isinstance(message, HeartbeatMessage):
+            self.beats[message.sender] = envelope
+
+        if response is None and not self.routed:
+            # a REP socket cannot park a request; have the worker repeat it
+            self.core.parked.pop(message.sender, None)
+
+            send_pyobj_gz(self.zmq_socket, Postponement(), envelope, self.codec)
+        elif response is None:
+            # answer any older parked request, which this one replaces
+            previous = self.parked.pop(message.sender, None)
+
+            if previous is not None:
+                self.send(previous[0], [], previous[1])
+
+            self.parked[message.sender] = (envelope, getattr(message, "cached", []))
+        else:
+            self.send(envelope, response, getattr(message, "cached", []), message.sender)
+
+        for (task, result) in completed:
+            self.finish(task.key)
+            self.handler(task, result)
+
+    def maintain(self):
+        """Release silent workers, and resize the worker pool."""
+
+        for condor_id in self.core.expire():
+            self.parked.pop(condor_id, None)
+            self.beats.pop(condor_id, None)
+
+        if self.pool is not None:
+            for condor_id in self.pool.adjust(self.core):
+                self.release(condor_id)
+
+    def assign(self, condor_id, tasks):
+        """Answer the parked request of a worker."""
+
+        (envelope, cached) = self.parked.pop(condor_id)
+
+        self.send(envelope, tasks, cached, condor_id)
+
+    def release(self, condor_id):
+        """Dismiss a worker, with a null assignment if it is waiting for one."""
+
+        parked = self.parked.pop(condor_id, None)
+
+        if parked is not None:
+            self.send(parked[0], [], parked[1])
+
+        self.beats.pop(condor_id, None)
+        self.core.drop(condor_id)
+
+    def finish(self, key):
+        """Release the shared arguments of a task that is complete or abandoned."""
+
+        if self.shared:
+            self.shared.release(key)
+
+    def cancel(self, condor_id, key):
+        """Tell a worker to abandon a cancelled task.
+
+        Over a ROUTER socket, the notice travels to the worker's heartbeat
+        socket, whose thread can interrupt the task. A REP socket cannot send
+        out of turn, so its workers, like those without heartbeats, finish
+        the task, and its result is discarded.
+        """
+
+        self.finish(key)
+
+        envelope = self.beats.get(condor_id)
+
+        if self.routed and envelope is not None:
+            send_pyobj_gz(self.zmq_socket, Cancellation(key), envelope, self.codec)
+
+    def send(self, envelope, tasks, cached, condor_id = None):
+        """Send an assignment to a worker."""
+
+        if self.shared and tasks:
+            tasks = self.shared.prepare(tasks, cached)
+
+        if tasks and self.setup is not None and condor_id not in self.initialized:
+            self.initialized.add(condor_id)
+
+            tasks = [self.setup] + tasks
+
+        send_pyobj_gz(self.zmq_socket, tasks, envelope, self.codec)
+
+    @staticmethod
+    def distribute(
+        tasks,
+        workers = 8,
+        handler = lambda _, x: x,
+        lease = 0,
+        asynchronous = True,
+        minimum = 1,
+        initializer = None,
+        launcher = "condor",
+        combine = None,
+        worker_processes = 0,
+        **options
+        ):
+        """Distribute computation to remote workers.
+
+        Each worker leases lease tasks per request, or sizes its leases from
+        observed task durations if lease is zero. Asynchronous workers prefetch
+        their next lease while working; otherwise workers fall back to REQ/REP.
+        The pool of between minimum and workers workers, started by launcher
+        (see launch_remote_workers), follows the amount of work remaining; each
+        worker runs its tasks in worker_processes subprocesses, if nonzero.
+        Further options are passed to the ManagerCore.
+        """
+
+        logger.info("distributing %s tasks to at most %i workers", describe_count(tasks), workers)
+
+        launched = launch_remote_workers(workers, lease, asynchronous, minimum, launcher, worker_processes)
+
+        with launched as (zmq_socket, pool):
+            manager = \
+                RemoteManager(
+                    tasks,
+                    handler,
+                    zmq_socket,
+                    pool = pool,
+                    initializer = initializer,
+                    combine = combine,
+                    **options
+                    )
+
+            pool.adjust(manager.core)
+
+            return manager.manage()
+
+@contextlib.contextmanager
+def launch_remote_workers(
+    workers,
+    lease = 0,
+    asynchronous = True,
+    minimum = 1,
+    launcher = "condor",
+    worker_processes = 0,
+    ):
+    """Bind a socket for remote workers, and manage a pool of them.
+
+    Each worker, if worker_processes is nonzero, relays its tasks to that
+    many local subprocesses over a single connection. The launcher is the
+    name of a standard pool ("condor" or "local"), or any callable that
+    builds a WorkerPool from the address to which workers should connect
+    and the pool options; eg, to start workers over ssh,
+    functools.partial(SSHWorkerPool, hosts = [...]).
+
+    Yields the socket and the worker pool; workers are removed, and the
+    socket closed, on exit.
+    """
+
+    import zmq
+
+    if isinstance(launcher, basestring):
+        launcher = worker_launchers[launcher]
+
+    hostname = getattr(launcher, "hostname", None)
+
+    if hostname is None:
+        hostname = socket.getfqdn()
+
+    # prepare zeromq
+    context = zmq.Context()
+
+    if asynchronous:
+        zmq_socket = context.socket(zmq.ROUTER)
+    else:
+        zmq_socket = context.socket(zmq.REP)
+
+    port = zmq_socket.bind_to_random_port("tcp://*")
+
+    logger.debug("listening on port %i", port)
+
+    # prepare to launch workers
+    worker_arguments = ["--lease", str(lease)]
+
+    if asynchronous:
+        worker_arguments.append("--dealer")
+
+    if worker_processes > 0:
+        worker_arguments.extend(["--processes", str(worker_processes)])
+
+    pool = \
+        launcher(
+            "tcp://%s:%i" % (hostname, port),
+            minimum = min(minimum, workers),
+            maximum = workers,
+            worker_arguments = worker_arguments,
+            )
+
+    try:
+        yield (zmq_socket, pool)
+    finally:
+        # clean up workers
+        pool.close()
+
+        logger.info("removed workers")
+
+        # clean up zeromq
+        zmq_socket.close()
+        context.term()
+
+        logger.info("terminated zeromq context")
+
+class WorkerPool(object):
+    """Grow and shrink a pool of remote workers with the work remaining.
+
+    The pool is sized to supply one worker per tasks_per_worker unfinished
+    tasks, and one per member of the largest task group still racing,
+    within [minimum, maximum], submitting more workers at most once
+    per interval seconds. Once no task is waiting to be started, idle
+    workers (parked, and holding no leases) beyond some spares (kept for
+    speculative re-execution) are released individually, as are submitted
+    jobs that never connected.
+
+    Subclasses implement submit(), remove(), and close(). Workers must be
+    started against req_address with the worker arguments, and identify
+    themselves to the manager by the identifiers that submit() returns.
+    """
+
+    # host at which workers reach the manager; None for this host's name
+    hostname = None
+
+    def __init__(
+        self,
+        req_address,
+        minimum = 1,
+        maximum = 8,
+        tasks_per_worker = 8,
+        spares = 1,
+        interval = 30.0,
+        worker_arguments = [],
+        ):
+        """Initialize."""
+
+        self.req_address = req_address
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tasks_per_worker = tasks_per_worker
+        self.spares = spares
+        self.interval = interval
+        self.worker_arguments = worker_arguments
+        self.jobs = set()
+        self.next_growth = 0.0
+
+    def submit(self, count):
+        """Start count more workers; return their identifiers."""
+
+        raise NotImplementedError()
+
+    def remove(self, condor_id):
+        """Stop one worker."""
+
+        raise NotImplementedError()
+
+    def adjust(self, core, now = None):
+        """Resize the pool; return the idle workers to release."""
+
+        if now is None:
+            now = time.time()
+
+        # grow
+        wanted = -(-core.unfinished_count() // self.tasks_per_worker)
+
+        if len(self.jobs) < self.maximum and now >= self.next_growth:
+            # the members of a task group race on separate workers
+            wanted = max(wanted, core.widest_group())
+
+        wanted = max(self.minimum, min(self.maximum, wanted))
+
+        if len(self.jobs) < wanted and now >= self.next_growth:
+            self.next_growth = now + self.interval
+
+            logger.info("growing worker pool from %i to %i", len(self.jobs), wanted)
+
+            self.jobs.update(self.submit(wanted - len(self.jobs)))
+
+        # shrink
+        if core.unstarted_count() > 0:
+            return []
+
+        released = []
+
+        # a parked worker may still be running the tasks it prefetched for
+        idle = [condor_id for condor_id in core.parked if not core.wstates[condor_id].leased]
+
+        for condor_id in idle[self.spares:]:
+            if len(self.jobs) - len(released) <= self.minimum:
+                break
+            elif condor_id in self.jobs:
+                released.append(condor_id)
+
+        for condor_id in sorted(self.jobs):
+            if len(self.jobs) - len(released) <= self.minimum:
+                break
+            elif condor_id not in core.wstates and condor_id not in released:
+                released.append(condor_id)
+
+        for condor_id in released:
+            self.jobs.discard(condor_id)
+            self.remove(condor_id)
+
+        if released:
+            logger.info("released %i idle workers; %i remain", len(released), len(self.jobs))
+
+        return released
+
+    def close(self):
+        """Stop every worker."""
+
+        raise NotImplementedError()
+
+class CondorWorkerPool(WorkerPool):
+    """A pool of workers submitted as Condor jobs."""
+
+    def __init__(self, req_address, **options):
+        """Initialize."""
+
+        WorkerPool.__init__(self, req_address, **options)
+
+        self.condor_home = cargo.default_condor_home()
+        self.clusters = []
+
+    def submit(self, count):
+        """Submit count more workers; return their job identifiers."""
+
+        cluster = \
+            cargo.submit_condor_workers(
+                count,
+                self.req_address,
+                condor_home = os.path.join(self.condor_home, str(len(self.clusters))),
+                worker_arguments = self.worker_arguments,
+                )
+
+        self.clusters.append(cluster)
+
+        return ["{0}.{1}".format(cluster, process) for process in xrange(count)]
+
+    def remove(self, condor_id):
+        """Remove one worker job."""
+
+        cargo.condor_rm(condor_id)
+
+    def close(self):
+        """Remove every worker job."""
+
+        for cluster in self.clusters:
+            cargo.condor_rm(cluster)
+
+        self.jobs.clear()
+
+class ProcessWorkerPool(WorkerPool):
+    """A pool of work2 processes started by command on this machine.
+
+    The command, by default, runs work2 under this interpreter; each
+    worker's arguments are appended to it. Worker output goes to this
+    process's stderr or, given a log directory, to a log file per worker.
+    Once max_failures workers in a row exit in error without connecting,
+    launching is presumed broken, and adjust() raises RuntimeError.
+    """
+
+    hostname = "127.0.0.1"
+
+    def __init__(
+        self,
+        req_address,
+        command = None,
+        interval = 1.0,
+        log_directory = None,
+        max_failures = 4,
+        **options
+        ):
+        """Initialize."""
+
+        WorkerPool.__init__(self, req_address, interval = interval, **options)
+
+        if command is None:
+            command = [sys.executable, "-m", "cargo.tools.labor.work2"]
+
+        self.command = command
+        self.log_directory = log_directory
+        self.max_failures = max_failures
+        self.failures = 0
+        self.processes = {}
+        self.started = 0
+
+    def build(self, number):
+        """Return the identifier and command line of a new worker."""
+
+        worker_id = "local.{0}".format(number)
+
+        return (worker_id, self.command + self.worker_arguments + [self.req_address, worker_id])
+
+    def submit(self, count):
+        """Start count more workers; return their identifiers."""
+
+        worker_ids = []
+
+        with open(os.devnull, "r") as devnull:
+            for _ in xrange(count):
+                (worker_id, arguments) = self.build(self.started)
+
+                if self.log_directory is None:
+                    # the descriptor of our stderr, which stays open
+                    log_file = None
+                    output = 2
+                else:
+                    log_file = open(os.path.join(self.log_directory, "{0}.log".format(worker_id)), "w")
+                    output = log_file
+
+                self.started += 1
+
+                try:
+                    self.processes[worker_id] = \
+                        subprocess.Popen(
+                            arguments,
+                            stdin = devnull,
+                            stdout = output,
+                            stderr = output,
+                            close_fds = True,
+                            )
+                finally:
+                    if log_file is not None:
+                        log_file.close()
+
+                worker_ids.append(worker_id)
+
+        return worker_ids
+
+    def remove(self, condor_id):
+        """Stop one worker."""
+
+        process = self.processes.pop(condor_id, None)
+
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    def adjust(self, core, now = None):
+        """Forget exited workers, then resize the pool.
+
+        Workers that exited after connecting are returned for release, with
+        the idle ones, so that their leases are requeued at once rather than
+        when they time out.
+        """
+
+        exited = []
+
+        for (worker_id, process) in self.processes.items():
+            if process.poll() is not None:
+                logger.warning("worker %s exited with status %i", worker_id, process.returncode)
+
+                del self.processes[worker_id]
+
+                self.jobs.discard(worker_id)
+
+                if worker_id in core.wstates:
+                    exited.append(worker_id)
+                elif process.returncode != 0:
+                    self.failures += 1
+
+                    if self.failures >= self.max_failures:
+                        raise RuntimeError("{0} workers in a row failed to start".format(self.failures))
+            elif worker_id in core.wstates:
+                self.failures = 0
+
+        released = WorkerPool.adjust(self, core, now)
+
+        return exited + [worker_id for worker_id in released if worker_id not in exited]
+
+    def close(self):
+        """Stop every worker."""
+
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.terminate()
+
+        for process in self.processes.values():
+            process.wait()
+
+        self.processes.clear()
+        self.jobs.clear()
+
+class SSHWorkerPool(ProcessWorkerPool):
+    """A pool of work2 processes started over ssh, spread across hosts.
+
+    The named python executable must exist on every host, with cargo
+    importable.
+    """
+
+    hostname = None
+
+    def __init__(
+        self,
+        req_address,
+        hosts,
+        python = "python",
+        ssh = ["ssh", "-tt", "-o", "BatchMode=yes"],
+        **options
+        ):
+        """Initialize."""
+
+        ProcessWorkerPool.__init__(
+            self,
+            req_address,
+            command = [python, "-m", "cargo.tools.labor.work2"],
+            **options
+            )
+
+        self.hosts = hosts
+        self.ssh = ssh
+
+    def build(self, number):
+        """Return the identifier and command line of a new worker."""
+
+        host = self.hosts[number % len(self.hosts)]
+        worker_id = "{0}.{1}".format(host, number)
+        arguments = self.command + self.worker_arguments + [self.req_address, worker_id]
+
+        return (worker_id, self.ssh + [host] + arguments)
+
+worker_launchers = {
+    "condor": CondorWorkerPool,
+    "local": ProcessWorkerPool,
+    }
+
+class LocalWorkerProcess(multiprocessing.Process):
+    """Work in a subprocess.
+
+    Messages in both directions are encoded with a SharedMemoryCodec on the
+    segment directory, so large arrays in task arguments and results do not
+    pass through the queues.
+
+    SIGUSR1 either stops the process or, after cancel(), makes it abandon
+    its current task and request another.
+    """
+
+    def __init__(self, stm_queue, directory, initializer = None):
+        """Initialize."""
+
+        multiprocessing.Process.__init__(self)
+
+        self.stm_queue = stm_queue
+        self.mts_queue = multiprocessing.Queue()
+        self.directory = directory
+        self.initializer = initializer
+        self.stopping = multiprocessing.RawValue("b", 0)
+        self.cancelling = multiprocessing.RawValue("l", 0)
+
+    def stop(self):
+        """Ask the process to exit."""
+
+        self.stopping.value = 1
+
+        self.interrupt()
+
+    def cancel(self, key):
+        """Ask the process to abandon a task, if it is still working on it."""
+
+        # keys are compared by hash, so a collision at worst reruns a task
+        self.cancelling.value = hash(key)
+
+        self.interrupt()
+
+    def interrupt(self):
+        """Send SIGUSR1 to the process, unless it has already exited."""
+
+        try:
+            os.kill(self.pid, signal.SIGUSR1)
+        except OSError, error:
+            if error.errno != errno.ESRCH:
+                raise
+
+    def send(self, message):
+        """Send a message to the manager."""
+
+        self.stm_queue.put(self.outputs.encode(message))
+
+    def receive(self):
+        """Receive an assignment from the manager, running any setup it carries."""
+
+        tasks = self.inputs.decode(self.mts_queue.get())
+
+        if tasks and isinstance(tasks[0], WorkerSetup):
+            initialize_worker(tasks.pop(0).initializer)
+
+        return tasks
+
+    def run(self):
+        """Work."""
+
+        class DeathRequestedError(Exception):
+            pass
+
+        running = [None]
+
+        try:
+            def handle_sigusr1(number, frame):
+                if self.stopping.value:
+                    raise DeathRequestedError()
+                elif running[0] is not None and hash(running[0]) == self.cancelling.value:
+                    running[0] = None
+
+                    raise TaskCancelledError()
+
+            signal.signal(signal.SIGUSR1, handle_sigusr1)
+
+            logger.info("subprocess running")
+
+            initialize_worker(self.initializer)
+
+            self.inputs = SharedMemoryCodec(self.directory, persistent = True)
+            self.outputs = SharedMemoryCodec(self.directory)
+
+            tasks = []
+
+            while True:
+                # get an assignment
+                if not tasks:
+                    self.send(ApplyMessage(os.getpid()))
+
+                    tasks = self.receive()
+
+                    if not tasks:
+                        logger.info("received null assignment; terminating")
+
+                        return None
+
+                task = tasks.pop()
+
+                # complete the assignment
+                try:
+                    seed = abs(hash(task.key)) % 2**32
+
+                    logger.info("setting PRNG seed to %s", seed)
+
+                    numpy.random.seed(seed)
+                    random.seed(numpy.random.randint(2**32))
+
+                    logger.info("starting work on task %s", task.key)
+
+                    started = time.time()
+                    running[0] = task.key
+                    _thread_state.task = task
+
+                    try:
+                        result = task()
+                    finally:
+                        running[0] = None
+                        _thread_state.task = None
+                except TaskCancelledError:
+                    logger.info("abandoning cancelled task %s", task.key)
+                except KeyboardInterrupt, error:
+                    logger.warning("interruption during task %s", task.key)
+
+                    self.send(InterruptedMessage(os.getpid(), task.key, {task.key: task.checkpoint}))
+                    self.receive()
+
+                    break
+                except DeathRequestedError:
+                    logger.warning("death requested; terminating")
+
+                    break
+                except BaseException, error:
+                    description = traceback.format_exc(error)
+
+                    logger.warning("error during task %s:\n%s", task.key, description)
+
+                    self.send(ErrorMessage(os.getpid(), task.key, description))
+                    self.receive()
+
+                    break
+                else:
+                    logger.info("finished task %s", task.key)
+
+                    duration = time.time() - started
+
+                    self.send(DoneMessage(os.getpid(), task.key, result, duration))
+
+                    tasks = self.receive()
         except DeathRequestedError:
             pass
 
-class LocalManager(object):
-    """Manage locally-distributed work."""
+class LocalManager(object):
+    """Manage locally-distributed work."""
+
+    def __init__(self, stm_queue, task_list, processes, handler, directory, core = None, **options):
+        """Initialize.
+
+        A core may be given to share its task queue with other managers, in
+        which case task_list is ignored; otherwise further options are passed
+        to the ManagerCore.
+        """
+
+        if core is None:
+            core = ManagerCore(task_list, speculator = Speculator(), **options)
+
+        self.stm_queue = stm_queue
+        self.core = core
+        self.processes = dict((process.pid, process) for process in processes)
+        self.handler = handler
+        self.inputs = SharedMemoryCodec(directory, persistent = True)
+        self.outputs = SharedMemoryCodec(directory)
+        self.next_check = time.time() + 1.0
+
+    def manage(self):
+        """Manage workers and tasks."""
+
+        while self.core.unfinished_count() > 0:
+            try:
+                encoded = self.stm_queue.get(timeout = self.core.poll_interval())
+            except queue.Empty:
+                pass
+            else:
+                self.receive(encoded)
+
+            # release the tasks of dead processes, and serve any waiting ones
+            now = time.time()
+
+            if not self.maintain(now):
+                raise RuntimeError("all worker processes died")
+
+            for (pid, tasks) in self.core.wake(now):
+                self.assign(pid, tasks)
+
+            for (pid, key) in self.core.cancellations():
+                self.cancel(pid, key)
+
+            self.core.report(now)
+
+        self.core.report(final = True)
+
+    def receive(self, encoded):
+        """Handle one message from a worker process."""
+
+        message = self.outputs.decode(encoded)
+
+        # any message ends the sender's use of its last assignment
+        self.inputs.release(message.sender)
+
+        (response, completed) = self.core.handle(message)
+
+        if response is not None:
+            self.assign(message.sender, response)
+
+        for (task, result) in completed:
+            self.handler(task, result)
+
+    def maintain(self, now):
+        """Release the tasks of dead processes; return the number living."""
+
+        if now >= self.next_check:
+            self.next_check = now + 1.0
+
+            for process in self.processes.values():
+                if not process.is_alive():
+                    logger.warning("worker process %i died; releasing its tasks", process.pid)
+
+                    self.core.drop(process.pid)
+                    self.inputs.release(process.pid)
+
+                    del self.processes[process.pid]
+
+        return len(self.processes)
+
+    def assign(self, pid, tasks):
+        """Send an assignment to a worker process."""
+
+        self.processes[pid].mts_queue.put(self.inputs.encode(tasks, pid))
+
+    def cancel(self, pid, key):
+        """Tell a worker process to abandon a cancelled task."""
+
+        process = self.processes.get(pid)
+
+        if process is not None:
+            process.cancel(key)
+
+    @staticmethod
+    def distribute(tasks, workers = 8, handler = lambda _, x: x, initializer = None, **options):
+        """Distribute computation to remote workers."""
+
+        logger.info("distributing %s tasks to %i workers", describe_count(tasks), workers)
+
+        with launch_local_workers(workers, initializer) as (stm_queue, processes, directory):
+            manager = LocalManager(stm_queue, tasks, processes, handler, directory, **options)
+
+            return manager.manage()
+
+@contextlib.contextmanager
+def launch_local_workers(workers, initializer = None):
+    """Start worker subprocesses, each first running initializer, if given.
+
+    Yields their shared message queue, the processes, and their shared-memory
+    directory; the processes are stopped, and the directory removed, on exit.
+    """
+
+    directory = tempfile.mkdtemp(prefix = "cargo.", dir = get_shared_memory_root())
+    stm_queue = multiprocessing.Queue()
+    processes = [LocalWorkerProcess(stm_queue, directory, initializer) for _ in xrange(workers)]
+
+    for process in processes:
+        process.start()
+
+    try:
+        yield (stm_queue, processes, directory)
+    finally:
+        for process in processes:
+            process.stop()
+
+        # the death request can be swallowed (eg, by a logging handler)
+        deadline = time.time() + 1.0
+
+        for process in processes:
+            process.join(max(0.0, deadline - time.time()))
+
+            if process.is_alive():
+                process.terminate()
 
-    def __init__(self, stm_queue, task_list, processes, handler):
+                process.join()
+
+        shutil.rmtree(directory, ignore_errors = True)
+
+        logger.info("cleaned up child processes")
+
+@contextlib.contextmanager
+def forward_queue(stm_queue, context):
+    """Forward the messages arriving on a queue to a zeromq socket.
+
+    A thread moves each message from the multiprocessing queue to an inproc
+    socket in context, which can then be polled alongside other zeromq
+    sockets. Yields that socket; the thread is stopped, and the socket
+    closed, on exit.
+    """
+
+    import zmq
+
+    address = "inproc://cargo-queue-%i" % id(stm_queue)
+    receiver = context.socket(zmq.PAIR)
+
+    receiver.bind(address)
+
+    def forward():
+        sender = context.socket(zmq.PAIR)
+
+        # never block on an unread backlog, which the manager may abandon
+        sender.setsockopt(zmq.SNDHWM, 0)
+        sender.connect(address)
+
+        try:
+            while True:
+                message = stm_queue.get()
+
+                if message is None:
+                    break
+
+                sender.send(message)
+        finally:
+            sender.close(linger = 0)
+
+    thread = threading.Thread(target = forward, name = "cargo-queue-forwarder")
+
+    thread.daemon = True
+
+    thread.start()
+
+    try:
+        yield receiver
+    finally:
+        stm_queue.put(None)
+        thread.join()
+        receiver.close(linger = 0)
+
+class ThreadWorker(threading.Thread):
+    """Work on tasks in a thread of the manager's process."""
+
+    def __init__(self, stm_queue, stopping, number):
         """Initialize."""
 
+        threading.Thread.__init__(self, name = "cargo-worker-%i" % number)
+
+        self.daemon = True
+        self.stm_queue = stm_queue
+        self.mts_queue = queue.Queue()
+        self.stopping = stopping
+
+    def send(self, message):
+        """Send a message to the manager."""
+
+        self.stm_queue.put(message)
+
+    def receive(self):
+        """Receive an assignment from the manager."""
+
+        return self.mts_queue.get()
+
+    def run(self):
+        """Work."""
+
+        tasks = []
+
+        while not self.stopping.is_set():
+            # get an assignment
+            if not tasks:
+                self.send(ApplyMessage(self.name))
+
+                tasks = self.receive()
+
+                if not tasks:
+                    return None
+
+            task = tasks.pop()
+
+            # complete the assignment
+            _thread_state.task = task
+
+            try:
+                logger.debug("starting work on task %s", task.key)
+
+                started = time.time()
+                result = task()
+            except BaseException, error:
+                description = traceback.format_exc(error)
+
+                logger.warning("error during task %s:\n%s", task.key, description)
+
+                self.send(ErrorMessage(self.name, task.key, description))
+                self.receive()
+
+                break
+            else:
+                logger.debug("finished task %s", task.key)
+
+                duration = time.time() - started
+
+                self.send(DoneMessage(self.name, task.key, result, duration))
+
+                tasks = self.receive()
+            finally:
+                _thread_state.task = None
+
+class ThreadManager(object):
+    """Manage work distributed to threads of this process.
+
+    Threads share the interpreter lock, so they suit I/O-bound tasks, such as
+    queries and subprocess calls; CPU-bound tasks belong in LocalManager.
+    Tasks and results are passed by reference, never pickled.
+    """
+
+    def __init__(self, stm_queue, task_list, threads, handler, core = None, **options):
+        """Initialize.
+
+        A core may be given to share its task queue with other managers, in
+        which case task_list is ignored; otherwise further options are passed
+        to the ManagerCore.
+        """
+
+        if core is None:
+            core = ManagerCore(task_list, speculator = Speculator(), **options)
+
         self.stm_queue = stm_queue
-        self.core = ManagerCore(task_list)
-        self.processes = processes
+        self.core = core
+        self.threads = dict((thread.name, thread) for thread in threads)
         self.handler = handler
 
     def manage(self):
         """Manage workers and tasks."""
 
-        process_index = dict((process.pid, process) for process in self.processes)
-
         while self.core.unfinished_count() > 0:
-            message = self.stm_queue.get()
+            try:
+                message = self.stm_queue.get(timeout = self.core.poll_interval())
+            except queue.Empty:
+                pass
+            else:
+                self.receive(message)
+
+            # release the tasks of failed threads, and serve any waiting ones
+            now = time.time()
+
+            if not self.maintain():
+                raise RuntimeError("all worker threads died")
+
+            for (name, tasks) in self.core.wake(now):
+                self.assign(name, tasks)
+
+            # threads cannot be interrupted; results of cancelled tasks are discarded
+            self.core.cancellations()
+
+            self.core.report(now)
+
+        self.core.report(final = True)
+
+    def receive(self, message):
+        """Handle one message from a worker thread."""
 
-            (response, completed) = self.core.handle(message)
+        (response, completed) = self.core.handle(message)
 
-            process_index[message.sender].mts_queue.put(response)
+        if response is not None:
+            self.assign(message.sender, response)
 
-            if completed is not None:
-                self.handler(*completed)
+        for (task, result) in completed:
+            self.handler(task, result)
+
+    def maintain(self):
+        """Release the tasks of exited threads; return the number living."""
+
+        for thread in self.threads.values():
+            if not thread.is_alive():
+                logger.warning("worker thread %s exited; releasing its tasks", thread.name)
+
+                self.core.drop(thread.name)
+
+                del self.threads[thread.name]
+
+        return len(self.threads)
+
+    def assign(self, name, tasks):
+        """Send an assignment to a worker thread."""
+
+        self.threads[name].mts_queue.put(tasks)
 
     @staticmethod
-    def distribute(tasks, workers = 8, handler = lambda _, x: x):
-        """Distribute computation to remote workers."""
+    def distribute(tasks, workers = 8, handler = lambda _, x: x, initializer = None, **options):
+        """Distribute computation to worker threads."""
 
-        logger.info("distributing %i tasks to %i workers", len(tasks), workers)
+        logger.info("distributing %s tasks to %i threads", describe_count(tasks), workers)
 
-        stm_queue = multiprocessing.Queue()
-        processes = [LocalWorkerProcess(stm_queue) for _ in xrange(workers)]
+        with launch_thread_workers(workers, initializer) as (stm_queue, threads):
+            manager = ThreadManager(stm_queue, tasks, threads, handler, **options)
 
-        for process in processes:
-            process.start()
+            return manager.manage()
+
+@contextlib.contextmanager
+def launch_thread_workers(workers, initializer = None):
+    """Start worker threads, after running initializer, if given, once.
+
+    Yields their shared message queue and the threads, which are asked to
+    stop on exit; a thread still busy with a task is abandoned as a daemon.
+    """
+
+    global _worker_context
+
+    outer_context = _worker_context
+
+    initialize_worker(initializer)
+
+    stm_queue = queue.Queue()
+    stopping = threading.Event()
+    threads = [ThreadWorker(stm_queue, stopping, n) for n in xrange(workers)]
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        yield (stm_queue, threads)
+    finally:
+        stopping.set()
+
+        for thread in threads:
+            thread.mts_queue.put([])
+
+        deadline = time.time() + 1.0
+
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.time()))
+
+        _worker_context = outer_context
+
+        logger.info("stopped worker threads")
+
+class HybridManager(object):
+    """Manage work distributed both to local processes and to remote workers.
+
+    Both kinds of worker are fed from the task queue of a single core.
+    """
+
+    def __init__(self, local, remote):
+        """Initialize from local and remote managers that share a core."""
+
+        assert local.core is remote.core
+
+        self.local = local
+        self.remote = remote
+        self.core = local.core
+
+        # a task completed locally may also have been sent to a remote worker
+        local_handler = local.handler
+
+        def handler(task, result):
+            remote.finish(task.key)
+
+            return local_handler(task, result)
+
+        local.handler = handler
+
+    def manage(self):
+        """Manage workers and tasks."""
+
+        import zmq
+
+        poller = zmq.Poller()
+        forwarded = forward_queue(self.local.stm_queue, self.remote.zmq_socket.context)
+
+        with forwarded as queue_socket:
+            poller.register(self.remote.zmq_socket, zmq.POLLIN)
+            poller.register(queue_socket, zmq.POLLIN)
+
+            while self.core.unfinished_count() > 0:
+                events = dict(poller.poll(1000 * self.core.poll_interval()))
+
+                if events.get(self.remote.zmq_socket) == zmq.POLLIN:
+                    self.remote.receive()
+
+                if events.get(queue_socket) == zmq.POLLIN:
+                    self.local.receive(queue_socket.recv())
+
+                # release dead and silent workers, and serve any waiting ones
+                now = time.time()
+
+                self.local.maintain(now)
+                self.remote.maintain()
+
+                for (worker, tasks) in self.core.wake(now):
+                    if worker in self.local.processes:
+                        self.local.assign(worker, tasks)
+                    else:
+                        self.remote.assign(worker, tasks)
+
+                for (worker, key) in self.core.cancellations():
+                    self.cancel(worker, key)
+
+                self.core.report(now)
+
+        self.core.report(final = True)
+
+    def cancel(self, worker, key):
+        """Tell a worker to abandon a cancelled task, wherever it runs."""
+
+        if worker in self.local.processes:
+            self.local.cancel(worker, key)
+
+            # the task may have been sent to a remote worker before
+            self.remote.finish(key)
+        else:
+            self.remote.cancel(worker, key)
+
+    @staticmethod
+    def distribute(
+        tasks,
+        workers = 8,
+        handler = lambda _, x: x,
+        local_workers = None,
+        lease = 0,
+        asynchronous = True,
+        minimum = 1,
+        initializer = None,
+        launcher = "condor",
+        combine = None,
+        worker_processes = 0,
+        **options
+        ):
+        """Distribute computation to local processes and remote workers.
+
+        The remote workers are launched as by RemoteManager.distribute(),
+        which describes the options they share; local_workers processes, by
+        default one per CPU, take tasks from the same queue. Further options
+        are passed to the ManagerCore.
+        """
+
+        if local_workers is None:
+            local_workers = multiprocessing.cpu_count()
+
+        logger.info(
+            "distributing %s tasks to %i local and at most %i remote workers",
+            describe_count(tasks),
+            local_workers,
+            workers,
+            )
+
+        core = ManagerCore(tasks, timeout = 60.0, speculator = Speculator(), **options)
+
+        with launch_local_workers(local_workers, initializer) as (stm_queue, processes, directory):
+            launched = launch_remote_workers(workers, lease, asynchronous, minimum, launcher, worker_processes)
+
+            with launched as (zmq_socket, pool):
+                local = LocalManager(stm_queue, None, processes, handler, directory, core = core)
+                remote = \
+                    RemoteManager(
+                        None,
+                        handler,
+                        zmq_socket,
+                        pool = pool,
+                        core = core,
+                        initializer = initializer,
+                        combine = combine,
+                        )
+
+                pool.adjust(core)
+
+                return HybridManager(local, remote).manage()
+
+class ConsumedList(object):
+    """A list of tasks that gives up each task as it is iterated.
+
+    A manager fed one, rather than a plain list, holds the only reference to
+    each task once admitted, so that tasks are freed as they complete.
+    """
+
+    def __init__(self, tasks):
+        """Initialize."""
+
+        self.tasks = list(tasks)
+
+        self.tasks.reverse()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __iter__(self):
+        while self.tasks:
+            yield self.tasks.pop()
+
+def describe_count(tasks):
+    """Describe, for logging, the number of tasks in a collection or stream."""
+
+    if isinstance(tasks, collections.Sized):
+        return str(len(tasks))
+    else:
+        return "streamed"
+
+def compute_serially(tasks, handler = lambda _, x: x, initializer = None, **options):
+    """Compute tasks in this process, in dependency order.
+
+    Further options are passed to the ManagerCore.
+    """
+
+    global _worker_context
+
+    core = ManagerCore(tasks, **options)
+    wstate = WorkerState(os.getpid())
+    outer_context = _worker_context
+
+    initialize_worker(initializer)
+
+    try:
+        while core.unfinished_count() > 0:
+            # let a slow consumer of results catch up
+            while core.held():
+                time.sleep(0.05)
+
+            (task,) = core.lease(wstate, 1, time.time())
+            started = time.time()
+
+            _thread_state.task = task
+
+            try:
+                result = task()
+            finally:
+                _thread_state.task = None
+
+            now = time.time()
+
+            message = DoneMessage(wstate.condor_id, task.key, result, now - started)
+
+            for (task, result) in core.complete(wstate, message, now):
+                handler(task, result)
+    finally:
+        _worker_context = outer_context
+
+def do_or_distribute(
+    requests,
+    workers,
+    handler = lambda _, x: x,
+    local = False,
+    journal = None,
+    local_workers = 0,
+    hold = None,
+    window = None,
+    cache = None,
+    initializer = None,
+    threaded = False,
+    launcher = "condor",
+    combine = None,
+    worker_processes = 0,
+    ):
+    """Distribute or compute locally.
+
+    If threaded, workers are threads of this process, which suit I/O-bound
+    tasks. Remote workers are started by launcher (see
+    launch_remote_workers), and each runs its tasks in worker_processes
+    subprocesses, if nonzero; remote runs may also use local_workers
+    subprocesses of this machine, which share a task queue with the remote
+    workers. While hold, if given, returns true, no worker, nor the serial
+    loop, is given new tasks.
+
+    Requests may be any iterable. Given a window, they are consumed lazily,
+    as workers free up, with at most window tasks outstanding.
+
+    If a journal (or the path to one) is given, tasks get stable keys, tasks
+    already recorded there are passed to the handler without being rerun,
+    and newly-completed results are appended to it.
+
+    If a result cache (or the path to one) is given, tasks whose results it
+    holds are passed to the handler without being dispatched, and
+    newly-completed results are stored in it.
+
+    An initializer, if given, is called once in each worker process, before
+    its first task; its return value is then available to tasks through
+    get_context(). It must be picklable for remote workers.
+
+    A combiner, if given, lets remote workers pass the handler partial
+    aggregates of their results; see reduce_or_distribute().
+    """
+
+    if combine is not None and (journal is not None or cache is not None):
+        raise ValueError("combined results cannot be journaled or cached")
+
+    tasks = itertools.imap(Task.from_request, requests)
+
+    known = {}
+
+    if journal is not None:
+        if isinstance(journal, basestring):
+            journal = ResultJournal(journal)
+
+        recorded = known = journal.load()
+        inner_handler = handler
+
+        def replay(tasks):
+            replayed = 0
+            total = 0
+
+            for task in iassign_stable_keys(tasks):
+                total += 1
+
+                if task.key in recorded:
+                    replayed += 1
+
+                    inner_handler(task, recorded[task.key])
+                else:
+                    yield task
+
+            logger.info("replayed %i of %i tasks from the journal", replayed, total)
+
+        def handler(task, result):
+            journal.record(task.key, result)
+
+            return inner_handler(task, result)
+
+        tasks = replay(tasks)
+
+    if cache is not None:
+        if isinstance(cache, basestring):
+            cache = ResultCache(cache)
+
+        names = {}
+        uncached_handler = handler
+
+        def resolve(tasks):
+            hits = 0
+
+            for task in tasks:
+                name = cache.name(task)
+
+                if name is not None:
+                    (hit, result) = cache.lookup(name)
+
+                    if hit:
+                        hits += 1
+                        known[task.key] = result
+
+                        uncached_handler(task, result)
+
+                        continue
+
+                    names[task.key] = name
+
+                yield task
+
+            logger.info("resolved %i tasks from the result cache", hits)
+
+        def handler(task, result):
+            name = names.pop(task.key, None)
+
+            if name is not None:
+                cache.store(name, result)
+
+            return uncached_handler(task, result)
+
+        tasks = resolve(tasks)
+
+    if window is None:
+        tasks = ConsumedList(tasks)
+    else:
+        try:
+            first = next(tasks)
+        except StopIteration:
+            tasks = []
+        else:
+            tasks = itertools.chain([first], tasks)
+
+    options = {"hold": hold, "window": window, "known": known, "initializer": initializer}
+
+    try:
+        if not tasks:
+            return None
+        elif workers > 0:
+            if threaded:
+                return ThreadManager.distribute(tasks, workers, handler, **options)
+            elif local:
+                return LocalManager.distribute(tasks, workers, handler, **options)
+            elif local_workers > 0:
+                return \
+                    HybridManager.distribute(
+                        tasks,
+                        workers,
+                        handler,
+                        local_workers,
+                        launcher = launcher,
+                        combine = combine,
+                        worker_processes = worker_processes,
+                        **options
+                        )
+            else:
+                return \
+                    RemoteManager.distribute(
+                        tasks,
+                        workers,
+                        handler,
+                        launcher = launcher,
+                        combine = combine,
+                        worker_processes = worker_processes,
+                        **options
+                        )
+        else:
+            return compute_serially(tasks, handler, **options)
+    finally:
+        if journal is not None:
+            journal.close()
+
+class TreeReducer(object):
+    """Merge values pairwise, as the leaves of a balanced binary tree.
+
+    Merging operands of similar weight keeps intermediate values of similar
+    size, and floating-point sums accurate.
+    """
+
+    def __init__(self, combine):
+        """Initialize."""
+
+        self.combine = combine
+        self.stack = []
+
+    def add(self, value):
+        """Merge in one more value."""
+
+        level = 0
+
+        while self.stack and self.stack[-1][0] == level:
+            (_, older) = self.stack.pop()
+
+            value = self.combine(older, value)
+            level += 1
+
+        self.stack.append((level, value))
+
+    def result(self):
+        """Return the merge of every value added, or None if none were."""
+
+        if not self.stack:
+            return None
+
+        (_, merged) = self.stack[-1]
+
+        for (_, older) in reversed(self.stack[:-1]):
+            merged = self.combine(older, merged)
+
+        return merged
+
+def reduce_or_distribute(requests, workers, combine, **kwargs):
+    """Distribute or compute locally, merging results into one aggregate.
+
+    The combiner must be associative and commutative, since results arrive
+    in no particular order; for remote workers, it must also be picklable.
+    Remote workers combine the results of each batch of their tasks, so only
+    partial aggregates reach the manager, which merges those, as it does the
+    results of local workers, pairwise. Tasks may not depend on one another.
+    Further arguments are passed to do_or_distribute(). Returns the
+    aggregate, or None if there were no tasks.
+    """
+
+    def independent(requests):
+        for request in requests:
+            task = Task.from_request(request)
+
+            if task.dependencies():
+                raise ValueError("reduced tasks cannot depend on other tasks")
+
+            yield task
+
+    reducer = TreeReducer(combine)
+
+    def handler(task, result):
+        if isinstance(result, PartialResult):
+            reducer.add(result.value)
+        else:
+            reducer.add(result)
+
+    do_or_distribute(independent(requests), workers, handler, combine = combine, **kwargs)
+
+    return reducer.result()
+
+class ResultStream(object):
+    """Buffer results between a dispatch thread and a consuming iterator.
+
+    Once capacity results are waiting, hold() turns true, so that the
+    dispatch loop stops leasing tasks; results of tasks already leased are
+    still accepted, so that the loop itself never blocks.
+    """
+
+    class Closed(Exception):
+        """The consumer has stopped iterating."""
+
+    def __init__(self, capacity = 256):
+        """Initialize."""
+
+        self.capacity = capacity
+        self.results = collections.deque()
+        self.condition = threading.Condition()
+        self.finished = False
+        self.closed = False
+        self.error = None
+
+    def hold(self):
+        """Should dispatch pause?"""
+
+        return not self.closed and len(self.results) >= self.capacity
+
+    def put(self, task, result):
+        """Accept a result; used as the dispatch handler."""
+
+        if self.closed:
+            raise ResultStream.Closed()
+
+        with self.condition:
+            self.results.append((task, result))
+
+            self.condition.notify()
+
+    def finish(self, error = None):
+        """Note that dispatch has ended, perhaps with an exception."""
+
+        with self.condition:
+            self.finished = True
+            self.error = error
+
+            self.condition.notify()
+
+    def __iter__(self):
+        """Yield (task, result) pairs as they arrive."""
 
         try:
-            return LocalManager(stm_queue, tasks, processes, handler).manage()
+            while True:
+                with self.condition:
+                    while not self.results and not self.finished:
+                        # wait in slices, so that KeyboardInterrupt is delivered
+                        self.condition.wait(1.0)
+
+                    if self.results:
+                        pair = self.results.popleft()
+                    elif self.error is not None:
+                        raise self.error[0], self.error[1], self.error[2]
+                    else:
+                        return
+
+                yield pair
         finally:
-            for process in processes:
-                os.kill(process.pid, signal.SIGUSR1)
+            self.closed = True
 
-            logger.info("cleaned up child processes")
+def iterate_or_distribute(requests, workers, buffered = 256, **kwargs):
+    """Distribute or compute locally, yielding (task, result) pairs as they complete.
 
-def do_or_distribute(requests, workers, handler = lambda _, x: x, local = False):
-    """Distribute or compute locally."""
+    Dispatch runs in a background thread; accepts the arguments of
+    do_or_distribute, except for the handler. At most roughly buffered
+    results, plus those of tasks already leased, wait to be consumed.
+    Abandoning the iterator stops dispatch when the next result arrives.
+    """
 
-    tasks = map(Task.from_request, requests)
+    stream = ResultStream(buffered)
 
-    if workers > 0:
-        if local:
-            return LocalManager.distribute(tasks, workers, handler)
+    def dispatch():
+        try:
+            do_or_distribute(requests, workers, stream.put, hold = stream.hold, **kwargs)
+        except ResultStream.Closed:
+            stream.finish()
+        except BaseException:
+            stream.finish(sys.exc_info())
         else:
-            return RemoteManager.distribute(tasks, workers, handler)
-    else:
-        while tasks:
-            task = tasks.pop()
-            result = task()
+            stream.finish()
+
+    thread = threading.Thread(target = dispatch)
+
+    thread.daemon = True
 
-            handler(task, result)
+    thread.start()
 
+    return iter(stream)
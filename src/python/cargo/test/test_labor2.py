@@ -0,0 +1,1616 @@
+"""
+@author: Bryan Silverthorn <bcs@cargo-cult.org>
+"""
+
+from nose.tools import (
+    assert_true,
+    assert_equal,
+    assert_not_equal,
+    assert_raises,
+    )
+
+def test_manager_core_schedule():
+    """
+    Test task selection and duplicate assignment in ManagerCore.
+    """
+
+    import time
+
+    from cargo.labor2 import (
+        Task,
+        ManagerCore,
+        ApplyMessage,
+        DoneMessage,
+        )
+
+    tasks = [Task(abs, [-i]) for i in xrange(3)]
+    core = ManagerCore(tasks)
+
+    # unassigned tasks are handed out first
+    assigned = []
+
+    for w in xrange(3):
+        assigned.extend(core.handle(ApplyMessage(w))[0])
+
+        time.sleep(1e-2)
+
+    assert_equal(sorted(t.key for t in assigned), sorted(t.key for t in tasks))
+
+    # then the least-recently-assigned task is duplicated
+    ((duplicate,), _) = core.handle(ApplyMessage(3))
+
+    assert_equal(duplicate.key, assigned[0].key)
+
+    # a result is reported only once
+    (_, completed) = core.handle(DoneMessage(3, duplicate.key, 0))
+
+    assert_equal(completed, [(duplicate, 0)])
+    assert_equal(core.done_count(), 1)
+
+    (_, completed) = core.handle(DoneMessage(0, duplicate.key, 0))
+
+    assert_equal(completed, [])
+    assert_equal(core.done_count(), 1)
+    assert_equal(core.unfinished_count(), 2)
+
+def test_manager_core_drain():
+    """
+    Test that ManagerCore completes every task exactly once.
+    """
+
+    from cargo.labor2 import (
+        Task,
+        ManagerCore,
+        ApplyMessage,
+        DoneMessage,
+        )
+
+    tasks = [Task(abs, [-i]) for i in xrange(64)]
+    core = ManagerCore(tasks)
+    finished = []
+    assigned = dict((w, core.handle(ApplyMessage(w))[0]) for w in xrange(5))
+
+    while core.unfinished_count() > 0:
+        for w in sorted(assigned):
+            for task in assigned[w]:
+                (assigned[w], completed) = core.handle(DoneMessage(w, task.key, task()))
+
+                finished.extend(completed)
+
+    assert_equal(sorted(r for (_, r) in finished), range(64))
+    assert_true(all(t() == r for (t, r) in finished))
+
+def test_manager_core_lease():
+    """
+    Test batched task leasing in ManagerCore.
+    """
+
+    from cargo.labor2 import (
+        Task,
+        ManagerCore,
+        ApplyMessage,
+        DoneMessage,
+        BatchMessage,
+        )
+
+    tasks = [Task(abs, [-i]) for i in xrange(10)]
+    core = ManagerCore(tasks)
+
+    (leased, _) = core.handle(ApplyMessage(0, 4))
+
+    assert_equal(len(leased), 4)
+    assert_equal(len(core.wstates[0].leased), 4)
+
+    done = [DoneMessage(0, t.key, t()) for t in leased]
+    (leased, completed) = core.handle(BatchMessage(0, done, 8))
+
+    assert_equal(len(completed), 4)
+    assert_equal(len(leased), 6)
+    assert_equal(core.unfinished_count(), 6)
+
+    # a worker never leases the same task twice
+    (leased, _) = core.handle(ApplyMessage(1, 8))
+
+    assert_equal(len(set(t.key for t in leased)), len(leased))
+
+def test_lease_sizer():
+    """
+    Test adaptive lease sizing.
+    """
+
+    from cargo.labor2 import LeaseSizer
+
+    assert_equal(LeaseSizer(3).size(), 3)
+
+    sizer = LeaseSizer(target = 1.0, maximum = 16)
+
+    assert_equal(sizer.size(), 1)
+
+    sizer.observe(0.25)
+
+    assert_equal(sizer.size(), 4)
+
+    for _ in xrange(32):
+        sizer.observe(1e-4)
+
+    assert_equal(sizer.size(), 16)
+
+def test_local_manager():
+    """
+    Test distribution of work to local subprocesses.
+    """
+
+    from cargo.labor2 import do_or_distribute
+
+    results = {}
+
+    def handler(task, result):
+        results[task.args[0]] = result
+
+    do_or_distribute([(abs, [-i]) for i in xrange(16)], 2, handler, local = True)
+
+    assert_equal(results, dict((-i, i) for i in xrange(16)))
+
+def test_message_codec():
+    """
+    Test message serialization with out-of-band numpy arrays.
+    """
+
+    import numpy
+
+    from cargo.labor2 import (
+        Task,
+        MessageCodec,
+        DoneMessage,
+        )
+
+    # small messages skip compression
+    codec = MessageCodec("bz2", threshold = 256, array_threshold = 128)
+    frames = codec.encode(DoneMessage(0, 42, "small"))
+
+    assert_equal(frames[0], "none")
+    assert_equal(codec.decode(frames).result, "small")
+
+    # large messages are compressed with the selected compressor
+    frames = codec.encode(DoneMessage(0, 42, "large" * 256))
+
+    assert_equal(frames[0], "bz2")
+    assert_equal(codec.decode(frames).result, "large" * 256)
+
+    # large arrays travel in frames of their own
+    big = numpy.arange(64.0).reshape((8, 8)).T
+    small = numpy.arange(8)
+    frames = codec.encode(Task(numpy.add, [big, small]))
+    decoded = codec.decode(frames)
+
+    assert_equal(len(frames), 3)
+    assert_true(numpy.all(decoded.args[0] == big))
+    assert_true(numpy.all(decoded.args[1] == small))
+    assert_true(numpy.all(decoded() == big + small))
+
+    # arrays received in zeromq frames are writeable, as local ones are
+    import zmq
+
+    context = zmq.Context()
+    sender = context.socket(zmq.PAIR)
+    receiver = context.socket(zmq.PAIR)
+
+    sender.bind("inproc://test_message_codec")
+    receiver.connect("inproc://test_message_codec")
+    sender.send_multipart(frames, copy = False)
+
+    decoded = codec.decode(receiver.recv_multipart(copy = False))
+
+    sender.close()
+    receiver.close()
+    context.term()
+
+    decoded.args[0] += 1
+
+    assert_true(numpy.all(decoded.args[0] == big + 1))
+
+def test_shared_arguments():
+    """
+    Test that large task arguments reach each worker only once.
+    """
+
+    import numpy
+
+    from cargo.labor2 import (
+        Task,
+        SharedArgument,
+        SharedArgumentIndex,
+        SharedArgumentCache,
+        )
+
+    big = numpy.arange(1024.0)
+    tasks = [Task(numpy.add, [big, i]) for i in xrange(4)]
+    index = SharedArgumentIndex(threshold = 1024)
+    cache = SharedArgumentCache()
+
+    # the first assignment attaches the value to one reference only
+    cached = cache.advertise()
+    sent = index.prepare(tasks[:2], cached)
+    references = [t.args[0] for t in sent]
+
+    assert_true(all(isinstance(r, SharedArgument) for r in references))
+    assert_equal([r.value is None for r in references], [False, True])
+    assert_equal(sent[1].args[1], 1)
+    assert_true(tasks[0].args[0] is big)
+
+    resolved = cache.resolve(sent)
+
+    cache.release(cached)
+
+    assert_true(all(t.args[0] is big for t in resolved))
+
+    # later assignments carry only the digest
+    cached = cache.advertise()
+    sent = index.prepare(tasks[2:], cached)
+
+    assert_true(all(t.args[0].value is None for t in sent))
+    assert_true(all(numpy.all(t() == big + i + 2) for (i, t) in enumerate(cache.resolve(sent))))
+
+    cache.release(cached)
+
+    # evicted values are sent again
+    cache.capacity = 0
+
+    cache.evict()
+
+    assert_equal(cache.advertise(), [])
+    assert_true(index.prepare(tasks[:1], [])[0].args[0].value is big)
+
+    # values are released with the last task that uses them
+    for task in tasks:
+        index.release(task.key)
+
+    assert_equal(index.by_id, {})
+
+    # a recycled object id never maps to a stale digest
+    for i in xrange(16):
+        # equal objects share a digest, not an id
+        original = numpy.zeros(1024)
+        twin = numpy.zeros(1024)
+
+        index.prepare([Task(numpy.sum, [original]), Task(numpy.sum, [twin])], [])
+
+        del original
+
+        value = numpy.ones(1024) * (i + 1)
+        (sent,) = index.prepare([Task(numpy.sum, [value])], [])
+
+        assert_equal(sent.args[0].digest, SharedArgumentIndex(threshold = 1024).share(value).digest)
+
+def test_result_journal():
+    """
+    Test that journaled results are replayed instead of recomputed.
+    """
+
+    import os.path
+    import threading
+    import numpy
+
+    from cargo.io import mkdtemp_scoped
+    from cargo.labor2 import (
+        ResultJournal,
+        do_or_distribute,
+        )
+
+    calls = []
+
+    def negate(x):
+        calls.append(x)
+
+        return -x
+
+    big = numpy.arange(16)
+
+    with mkdtemp_scoped() as box_path:
+        journal_path = os.path.join(box_path, "journal")
+        results = {}
+
+        def handler(task, result):
+            results[task.key] = result
+
+        do_or_distribute([(negate, [i]) for i in xrange(8)], 0, handler, journal = journal_path)
+
+        assert_equal(sorted(calls), range(8))
+
+        # simulate a crash partway through writing one more record
+        journal = ResultJournal(journal_path)
+
+        journal.record(("partial", 0), None)
+        journal.close()
+
+        with open(journal_path, "r+b") as journal_file:
+            journal_file.truncate(os.path.getsize(journal_path) - 1)
+
+        # only the new tasks are run again, though negate's closure has changed
+        results.clear()
+
+        requests = [(negate, [i]) for i in xrange(10)] + [(numpy.sum, [big])]
+
+        do_or_distribute(requests, 0, handler, journal = journal_path)
+
+        assert_equal(sorted(calls[8:]), [8, 9])
+        assert_equal(len(results), 11)
+        assert_equal(len(ResultJournal(journal_path).load()), 11)
+
+        # nor need its closure be picklable
+        lock = threading.Lock()
+
+        def locked(x):
+            with lock:
+                return x
+
+        do_or_distribute([(locked, [1])], 0, journal = os.path.join(box_path, "locked"))
+
+        # but an unpicklable callable, eg a bound method, cannot be journaled
+        class Counter(object):
+            def count(self):
+                return 1
+
+        bound = Counter().count
+
+        assert_raises(ValueError, do_or_distribute, [(bound,)], 0, journal = os.path.join(box_path, "bound"))
+
+def test_manager_core_stragglers():
+    """
+    Test speculative re-execution and dead-worker detection in ManagerCore.
+    """
+
+    import time
+
+    from cargo.labor2 import (
+        Task,
+        Speculator,
+        ManagerCore,
+        ApplyMessage,
+        DoneMessage,
+        HeartbeatMessage,
+        )
+
+    tasks = [Task(abs, [-i]) for i in xrange(3)]
+    core = ManagerCore(tasks, timeout = 1.0, speculator = Speculator(minimum = 0.05))
+    assigned = [core.handle(ApplyMessage(w))[0][0] for w in xrange(3)]
+
+    # with nothing yet straggling, an idle worker waits
+    (response, completed) = core.handle(DoneMessage(0, assigned[0].key, 0, 0.01))
+
+    assert_equal(response, None)
+    assert_equal(completed, [(assigned[0], 0)])
+    assert_equal(core.wake(), [])
+
+    # a straggler is eventually duplicated
+    now = time.time() + 0.1
+    ((woken, (duplicate,)),) = core.wake(now)
+
+    assert_equal(woken, 0)
+    assert_true(duplicate in assigned[1:])
+
+    # a silent worker is forgotten, and its task released
+    core.handle(HeartbeatMessage(1, assigned[1].key, 0.0))
+    core.handle(HeartbeatMessage(2, assigned[2].key, 0.0))
+
+    core.wstates[2].seen = now + 1.0
+
+    assert_equal(core.expire(now + 1.5), [1])
+    assert_equal(sorted(core.wstates), [0, 2])
+    assert_equal(len(core.tstates[assigned[1].key].working), int(duplicate is assigned[1]))
+
+    # tasks queued by a worker that sends heartbeats straggle only once started
+    tasks = [Task(abs, [-i]) for i in xrange(3)]
+    core = ManagerCore(tasks, speculator = Speculator(minimum = 0.05))
+
+    core.handle(HeartbeatMessage(0))
+
+    (queued, _) = core.handle(ApplyMessage(0, 2))
+    (done, _) = core.handle(ApplyMessage(1))
+
+    core.handle(DoneMessage(1, done[0].key, 0, 0.01))
+
+    assert_equal(core.wake(time.time() + 10.0), [])
+
+    # and are timed from when the worker says they started, by the manager's clock
+    core.handle(HeartbeatMessage(0, queued[1].key, 10.0))
+
+    assert_equal(core.wake(), [(1, [queued[1]])])
+
+def test_shared_memory_codec():
+    """
+    Test passing large arrays through shared-memory segments.
+    """
+
+    import os
+    import numpy
+
+    from cargo.io import mkdtemp_scoped
+    from cargo.labor2 import (
+        SharedMemoryCodec,
+        do_or_distribute,
+        )
+
+    big = numpy.arange(2**14, dtype = numpy.float64)
+
+    with mkdtemp_scoped() as box_path:
+        # one-shot segments are unlinked once mapped
+        sender = SharedMemoryCodec(box_path)
+        receiver = SharedMemoryCodec(box_path)
+        encoded = sender.encode({"big": big, "small": big[:4]})
+
+        assert len(encoded) < 1024
+        assert_equal(len(os.listdir(box_path)), 1)
+
+        decoded = receiver.decode(encoded)
+
+        assert_equal(os.listdir(box_path), [])
+        assert numpy.all(decoded["big"] == big)
+        assert numpy.all(decoded["small"] == big[:4])
+
+        # persistent segments are written once, and mapped copy-on-write
+        sender = SharedMemoryCodec(box_path, persistent = True)
+        receiver = SharedMemoryCodec(box_path, persistent = True)
+        (first, again) = receiver.decode(sender.encode([big, big], "a"))
+        (second,) = receiver.decode(sender.encode([big], "b"))
+
+        assert_equal(len(os.listdir(box_path)), 1)
+        assert first is again
+
+        first += 1
+
+        assert numpy.all(second == big)
+        assert numpy.all(receiver.decode(sender.encode([big], "b"))[0] == big)
+
+        # and unlinked once the last owner releases them
+        sender.release("a")
+
+        assert_equal(len(os.listdir(box_path)), 1)
+
+        sender.release("b")
+
+        assert_equal(os.listdir(box_path), [])
+        assert_equal(sender.written, {})
+
+        del first
+        del second
+
+        sender.encode([big], "c")
+
+        assert_equal(len(os.listdir(box_path)), 1)
+
+    # large inputs and results round-trip through local workers
+    results = {}
+
+    def handler(task, result):
+        results[task.args[1]] = result
+
+    requests = [(numpy.multiply, [big, i]) for i in xrange(4)]
+
+    do_or_distribute(requests, 2, handler, local = True)
+
+    assert_equal(sorted(results), range(4))
+
+    for (i, result) in results.items():
+        assert numpy.all(result == big * i)
+
+    # and tasks may change their inputs in place, each in its own copy
+    sums = []
+
+    do_or_distribute([(increment_in_place, [big]) for _ in xrange(4)], 2, lambda _, x: sums.append(x), local = True)
+
+    assert_equal(sums, [numpy.sum(big + 1)] * 4)
+
+def increment_in_place(array):
+    """Add one to an array in place; return its sum; for test_shared_memory_codec."""
+
+    array += 1
+
+    return array.sum()
+
+def test_manager_core_costs():
+    """
+    Test longest-expected-first scheduling in ManagerCore.
+    """
+
+    from cargo.labor2 import (
+        Task,
+        ManagerCore,
+        ApplyMessage,
+        DoneMessage,
+        BatchMessage,
+        )
+
+    # explicit priorities come first, then explicit cost estimates
+    tasks = [Task(abs, [-i], cost = i) for i in xrange(4)] + [Task(abs, [-9], priority = 1)]
+    core = ManagerCore(tasks)
+    (assigned, _) = core.handle(ApplyMessage(0, count = 5))
+
+    assert_equal([t.args[0] for t in assigned], [-9, -3, -2, -1, 0])
+
+    # without estimates, costs are learned per family
+    tasks = [Task(abs, [-i]) for i in xrange(4)] + [Task(len, ["x" * i]) for i in xrange(4)]
+    core = ManagerCore(tasks)
+
+    done = [
+        DoneMessage(0, tasks[0].key, None, 1.0),
+        DoneMessage(0, tasks[4].key, None, 10.0),
+        ]
+
+    core.handle(BatchMessage(0, done, count = 0))
+
+    (assigned, _) = core.handle(ApplyMessage(1, count = 6))
+
+    assert_equal([t.call.__name__ for t in assigned], ["len"] * 3 + ["abs"] * 3)
+
+def test_metrics():
+    """
+    Test scheduling instrumentation.
+    """
+
+    import json
+
+    from cargo.labor2 import (
+        Task,
+        Histogram,
+        ManagerCore,
+        ApplyMessage,
+        DoneMessage,
+        )
+
+    histogram = Histogram()
+
+    for value in [0.5, 1.0, 1.5, 3.0]:
+        histogram.add(value)
+
+    summary = histogram.summarize()
+
+    assert_equal(summary["count"], 4)
+    assert_equal(summary["mean"], 1.5)
+    assert_equal(summary["p50"], 2.0)
+    assert_equal(summary["p99"], 3.0)
+
+    tasks = [Task(abs, [-i]) for i in xrange(2)]
+    core = ManagerCore(tasks)
+    (assigned, _) = core.handle(ApplyMessage(0, count = 2))
+
+    for task in assigned:
+        core.handle(DoneMessage(0, task.key, None, 0.25))
+
+    summary = json.loads(core.metrics.dumps(done = core.done_count()))
+
+    assert_equal(summary["done"], 2)
+    assert_equal(summary["counters"]["manager.messages"], 3)
+    assert_equal(summary["counters"]["tasks.completed"], 2)
+    assert_equal(summary["histograms"]["task.run_seconds"]["total"], 0.5)
+    assert_equal(summary["histograms"]["task.wait_seconds"]["count"], 2)
+
+def test_condor_worker_pool():
+    """
+    Test growing and shrinking a pool of Condor workers.
+    """
+
+    from cargo.labor2 import (
+        Task,
+        Speculator,
+        ManagerCore,
+        ApplyMessage,
+        DoneMessage,
+        BatchMessage,
+        CondorWorkerPool,
+        )
+
+    class FakePool(CondorWorkerPool):
+        removed = []
+
+        def submit(self, count):
+            return ["7.{0}".format(i) for i in xrange(count)]
+
+        def remove(self, condor_id):
+            self.removed.append(condor_id)
+
+    tasks = [Task(abs, [-i]) for i in xrange(20)]
+    core = ManagerCore(tasks, speculator = Speculator())
+    pool = FakePool("tcp://localhost:0", maximum = 4, spares = 0)
+
+    # the pool grows to cover the work outstanding
+    assert_equal(pool.adjust(core, 0.0), [])
+    assert_equal(sorted(pool.jobs), ["7.0", "7.1", "7.2"])
+
+    # once every task has started, workers that never connected are released
+    (leased, _) = core.handle(ApplyMessage("7.0", count = 10))
+    core.handle(ApplyMessage("7.1", count = 10))
+
+    assert_equal(core.unstarted_count(), 0)
+    assert_equal(pool.adjust(core, 1.0), ["7.2"])
+
+    # as are idle workers, but not those parked while still working
+    (response, _) = core.handle(DoneMessage("7.1", core.wstates["7.1"].leased.keys()[0], None, 1.0))
+
+    assert response is None
+    assert_equal(pool.adjust(core, 1.5), [])
+
+    done = [DoneMessage("7.0", task.key, None, 1.0) for task in leased]
+    (response, _) = core.handle(BatchMessage("7.0", done))
+
+    assert response is None
+    assert_equal(pool.adjust(core, 2.0), ["7.0"])
+    assert_equal(sorted(pool.jobs), ["7.1"])
+    assert_equal(pool.removed, ["7.2", "7.0"])
+
+def exit_abruptly():
+    """Kill this worker process; for test_local_worker_death."""
+
+    import os
+    import time
+
+    # let the queue's feeder thread release its lock first
+    time.sleep(0.25)
+
+    os._exit(1)
+
+def test_local_worker_death():
+    """
+    Test reporting the death of every local worker process.
+    """
+
+    from cargo.labor2 import do_or_distribute
+
+    assert_raises(RuntimeError, do_or_distribute, [(exit_abruptly,)], 2, local = True)
+
+def identify_after(seconds):
+    """Sleep, then return this process's id; for test_hybrid_manager."""
+
+    import os
+    import time
+
+    time.sleep(seconds)
+
+    return os.getpid()
+
+def test_hybrid_manager():
+    """
+    Test sharing one task queue between local and remote workers.
+    """
+
+    import zmq
+    import numpy
+
+    from cargo.labor2 import (
+        Task,
+        Speculator,
+        ManagerCore,
+        LocalManager,
+        RemoteManager,
+        HybridManager,
+        SharedArgumentIndex,
+        launch_local_workers,
+        do_or_distribute,
+        )
+
+    results = {}
+
+    def handler(task, result):
+        results[task.args[0]] = result
+
+    tasks = [Task(abs, [-i]) for i in xrange(16)]
+    core = ManagerCore(tasks, speculator = Speculator())
+    context = zmq.Context()
+    zmq_socket = context.socket(zmq.ROUTER)
+
+    zmq_socket.bind("inproc://test_hybrid_manager")
+
+    try:
+        with launch_local_workers(2) as (stm_queue, processes, directory):
+            local = LocalManager(stm_queue, None, processes, handler, directory, core = core)
+            remote = RemoteManager(None, handler, zmq_socket, core = core)
+
+            HybridManager(local, remote).manage()
+
+        assert_equal(results, dict((-i, i) for i in xrange(16)))
+
+        # a task cancelled locally gives up arguments shared with remote workers
+        task = Task(numpy.sum, [numpy.arange(1024.0)])
+        core = ManagerCore([task])
+
+        with launch_local_workers(1) as (stm_queue, processes, directory):
+            local = LocalManager(stm_queue, None, processes, handler, directory, core = core)
+            shared = SharedArgumentIndex(threshold = 1024)
+            remote = RemoteManager(None, handler, zmq_socket, shared = shared, core = core)
+
+            shared.prepare([task], [])
+
+            assert_true(shared.held)
+
+            HybridManager(local, remote).cancel(processes[0].pid, task.key)
+
+            assert_equal(shared.held, {})
+    finally:
+        zmq_socket.close()
+        context.term()
+
+    # work2 workers, started by a launcher, share the queue with local ones
+    pids = []
+
+    def identified(task, pid):
+        pids.append(pid)
+
+    requests = [Task(identify_after, [0.05]) for _ in xrange(64)]
+
+    do_or_distribute(requests, 1, identified, local_workers = 1, launcher = "local")
+
+    assert_equal(len(pids), 64)
+    assert_equal(len(set(pids)), 2)
+
+def test_iterate_or_distribute():
+    """
+    Test streaming results through an iterator.
+    """
+
+    from cargo.labor2 import (
+        ResultStream,
+        iterate_or_distribute,
+        )
+
+    # serial results arrive in order
+    pairs = list(iterate_or_distribute([(abs, [-i]) for i in xrange(8)], 0))
+
+    assert_equal([result for (_, result) in pairs], range(8))
+
+    # distributed results arrive in some order
+    pairs = iterate_or_distribute([(abs, [-i]) for i in xrange(32)], 2, buffered = 4, local = True)
+
+    assert_equal(sorted(result for (_, result) in pairs), range(32))
+
+    # dispatch is held while the buffer is full
+    stream = ResultStream(2)
+
+    stream.put(None, 0)
+
+    assert not stream.hold()
+
+    stream.put(None, 1)
+
+    assert stream.hold()
+
+    stream.finish()
+
+    assert_equal([result for (_, result) in stream], [0, 1])
+
+    # errors are raised in the consumer
+    def fail():
+        raise ValueError()
+
+    assert_raises(ValueError, list, iterate_or_distribute([(fail,)], 0))
+
+def test_backpressure():
+    """
+    Test pausing dispatch while the consumer of results is behind.
+    """
+
+    import time
+    import threading
+    import zmq
+
+    from cargo.labor2 import (
+        Task,
+        Postponement,
+        RemoteManager,
+        ApplyMessage,
+        DoneMessage,
+        send_pyobj_gz,
+        recv_pyobj_gz,
+        iterate_or_distribute,
+        )
+
+    # the serial loop runs at most a buffer's worth of tasks ahead
+    calls = []
+
+    def record(i):
+        calls.append(i)
+
+        return i
+
+    pairs = iterate_or_distribute([(record, [i]) for i in xrange(32)], 0, buffered = 4)
+
+    assert_equal(next(pairs)[1], 0)
+
+    time.sleep(0.5)
+
+    assert len(calls) <= 6
+
+    assert_equal([result for (_, result) in pairs], range(1, 32))
+
+    # a REP socket answers held requests with a postponement
+    held = [True]
+    results = {}
+
+    def handler(task, result):
+        results[task.args[0]] = result
+
+    context = zmq.Context()
+    rep = context.socket(zmq.REP)
+    req = context.socket(zmq.REQ)
+
+    rep.bind("inproc://test_backpressure")
+    req.setsockopt(zmq.LINGER, 0)
+    req.connect("inproc://test_backpressure")
+
+    manager = RemoteManager([Task(abs, [-1])], handler, rep, hold = lambda: held[0])
+    thread = threading.Thread(target = manager.manage)
+
+    thread.daemon = True
+
+    thread.start()
+
+    try:
+        send_pyobj_gz(req, ApplyMessage(0))
+
+        assert_true(isinstance(recv_pyobj_gz(req), Postponement))
+
+        held[0] = False
+
+        send_pyobj_gz(req, ApplyMessage(0))
+
+        (task,) = recv_pyobj_gz(req)
+
+        send_pyobj_gz(req, DoneMessage(0, task.key, task(), 0.1))
+
+        thread.join(10.0)
+
+        assert_true(not thread.is_alive())
+        assert_equal(results, {-1: 1})
+    finally:
+        req.close()
+        rep.close()
+        context.term()
+
+def test_lazy_task_source():
+    """
+    Test pulling tasks lazily from a bounded window.
+    """
+
+    from cargo.labor2 import (
+        Task,
+        ManagerCore,
+        ApplyMessage,
+        DoneMessage,
+        do_or_distribute,
+        )
+
+    pulled = []
+
+    def source():
+        for i in xrange(10):
+            pulled.append(i)
+
+            yield Task(abs, [-i])
+
+    core = ManagerCore(source(), window = 3)
+
+    assert_equal(len(pulled), 3)
+    assert_equal(core.unfinished_count(), 3)
+
+    # completing tasks admits more, until the source runs dry
+    (tasks, _) = core.handle(ApplyMessage(0, count = 3))
+    completed = []
+
+    while tasks:
+        task = tasks.pop()
+        (more, done) = core.handle(DoneMessage(0, task.key, task()))
+
+        tasks.extend(more)
+        completed.extend(done)
+
+        assert len(core.tstates) <= 3
+
+    assert_equal(sorted(r for (_, r) in completed), range(10))
+    assert_equal(core.unfinished_count(), 0)
+
+    # the window is respected end to end
+    results = {}
+
+    def handler(task, result):
+        results[task.args[0]] = result
+
+    requests = ((abs, [-i]) for i in xrange(32))
+
+    do_or_distribute(requests, 2, handler, local = True, window = 4)
+
+    assert_equal(results, dict((-i, i) for i in xrange(32)))
+
+def test_result_cache():
+    """
+    Test persistent memoization of task results.
+    """
+
+    import os
+    import numpy
+
+    from cargo.io import mkdtemp_scoped
+    from cargo.labor2 import (
+        Task,
+        ResultCache,
+        do_or_distribute,
+        )
+
+    calls = []
+
+    def negate(x):
+        calls.append(x)
+
+        return -x
+
+    with mkdtemp_scoped() as box_path:
+        cache_path = os.path.join(box_path, "cache")
+        results = {}
+
+        def handler(task, result):
+            results[task.args[0]] = result
+
+        do_or_distribute([(negate, [i]) for i in xrange(4)], 0, handler, cache = cache_path)
+
+        assert_equal(sorted(calls), range(4))
+
+        # only new tasks are run, in a later run
+        del calls[:]
+
+        results.clear()
+
+        do_or_distribute([(negate, [i]) for i in xrange(6)], 0, handler, cache = cache_path)
+
+        assert_equal(sorted(calls), [4, 5])
+        assert_equal(results, dict((i, -i) for i in xrange(6)))
+
+        # least-recently-used results are evicted beyond capacity
+        big = numpy.arange(1024)
+        cache = ResultCache(os.path.join(box_path, "small"), capacity = 2 * big.nbytes)
+        names = [cache.name(Task(negate, [i])) for i in xrange(3)]
+
+        for name in names:
+            cache.store(name, big)
+
+        assert_equal(cache.lookup(names[0]), (False, None))
+        assert cache.lookup(names[2])[0]
+        assert cache.size <= cache.capacity
+
+        # distinct closures of the same name do not share results
+        def adder(n):
+            return lambda x: x + n
+
+        results.clear()
+
+        do_or_distribute([(adder(1), [0])], 0, handler, cache = cache_path)
+
+        assert_equal(results, {0: 1})
+
+        do_or_distribute([(adder(2), [0])], 0, handler, cache = cache_path)
+
+        assert_equal(results, {0: 2})
+        assert_not_equal(cache.name(Task(adder(1), [0])), cache.name(Task(adder(2), [0])))
+
+def test_task_dependencies():
+    """
+    Test releasing dependent tasks as their inputs complete.
+    """
+
+    from cargo.labor2 import (
+        Task,
+        ManagerCore,
+        ApplyMessage,
+        DoneMessage,
+        do_or_distribute,
+        )
+
+    # dependents wait for their dependencies, which are admitted with them
+    fit = Task(sum, [[1, 2, 3]])
+    evaluations = [Task(pow, [fit, i]) for i in xrange(3)]
+    core = ManagerCore(evaluations)
+
+    assert_equal(core.unfinished_count(), 4)
+
+    (leased, _) = core.handle(ApplyMessage(0, count = 4))
+
+    assert_equal(leased, [fit])
+
+    (leased, completed) = core.handle(DoneMessage(0, fit.key, 6))
+
+    assert_equal(completed, [(fit, 6)])
+    assert_equal(leased[0].args, [6, 0])
+
+    (more, _) = core.handle(ApplyMessage(1, count = 2))
+
+    assert_equal(sorted(t.args[1] for t in leased + more), [0, 1, 2])
+    assert_equal(core.results, {})
+
+    # results flow through every mode of execution
+    for (workers, local) in [(0, False), (2, True)]:
+        results = {}
+
+        def handler(task, result):
+            results[task.key] = result
+
+        total = Task(sum, [[1, 2, 3]])
+        square = Task(pow, [total, 2])
+        both = Task(dict, [], {"square": square, "total": total})
+
+        do_or_distribute([both, square], workers, handler, local = local)
+
+        assert_equal(results, {total.key: 6, square.key: 36, both.key: {"square": 36, "total": 6}})
+
+def build_worker_context():
+    """Build a worker-local context for test_worker_initializer."""
+
+    import os
+
+    return {"pid": os.getpid()}
+
+def read_worker_context(i):
+    """Read the worker-local context from within a task."""
+
+    import os
+    import cargo.labor2
+
+    return (i, cargo.labor2.get_context()["pid"], os.getpid())
+
+def test_worker_initializer():
+    """
+    Test running an initializer once per worker process.
+    """
+
+    import os
+    import cargo.labor2
+
+    from cargo.labor2 import (
+        Task,
+        get_context,
+        do_or_distribute,
+        )
+
+    for (workers, local) in [(0, False), (2, True)]:
+        results = []
+
+        def handler(task, result):
+            results.append(result)
+
+        requests = [(read_worker_context, [i]) for i in xrange(16)]
+
+        do_or_distribute(requests, workers, handler, local = local, initializer = build_worker_context)
+
+        assert_equal(sorted(i for (i, _, _) in results), range(16))
+
+        for (_, context_pid, task_pid) in results:
+            assert_equal(context_pid, task_pid)
+
+        if not local:
+            assert_equal(results[0][2], os.getpid())
+
+    # the serial context does not outlive its computation
+    assert_equal(get_context(), None)
+
+    # initializers may also carry arguments, as tasks
+    do_or_distribute([(get_context, [])], 0, handler, initializer = Task(dict, [], {"a": 1}))
+
+    assert_equal(results[-1], {"a": 1})
+
+def test_thread_manager():
+    """
+    Test computing tasks in worker threads.
+    """
+
+    import threading
+
+    from cargo.labor2 import (
+        Task,
+        get_task,
+        get_context,
+        do_or_distribute,
+        )
+
+    results = {}
+    names = set()
+
+    def work(i):
+        names.add(threading.current_thread().name)
+
+        return (i, get_task().args[0], get_context())
+
+    def handler(task, result):
+        results[task.args[0]] = result
+
+    requests = [(work, [i]) for i in xrange(64)]
+
+    do_or_distribute(requests, 4, handler, threaded = True, initializer = lambda: "warm")
+
+    assert_equal(results, dict((i, (i, i, "warm")) for i in xrange(64)))
+    assert_true(names <= set("cargo-worker-%i" % i for i in xrange(4)))
+    assert_equal(get_context(), None)
+
+    # a failed task is retried on another thread
+    failures = []
+
+    def flaky(i):
+        if not failures:
+            failures.append(i)
+
+            raise ValueError()
+
+        return i
+
+    results.clear()
+
+    do_or_distribute([Task(flaky, [i]) for i in xrange(8)], 2, handler, threaded = True)
+
+    assert_equal(results, dict((i, i) for i in xrange(8)))
+
+def test_benchmark():
+    """
+    Test measuring dispatch overhead.
+    """
+
+    from cargo.tools.labor.benchmark import run_benchmark
+
+    for backend in ["threads", "local"]:
+        measured = run_benchmark(backend, "payload", 2, 16, size = 64)
+
+        assert_equal(measured["count"], 16)
+        assert_true(measured["tasks_per_second"] > 0.0)
+        assert_true(measured["manager_cpu_seconds"] >= 0.0)
+
+def test_process_worker_pool():
+    """
+    Test distributing to work2 processes through the local launcher.
+    """
+
+    import os
+    import sys
+    import time
+    import numpy
+
+    from cargo.io import mkdtemp_scoped
+    from cargo.labor2 import (
+        Task,
+        ManagerCore,
+        ApplyMessage,
+        SSHWorkerPool,
+        ProcessWorkerPool,
+        do_or_distribute,
+        )
+
+    # end to end, through zeromq
+    results = {}
+
+    def handler(task, result):
+        results[len(task.args[0])] = result
+
+    requests = [(numpy.sum, [numpy.arange(i)]) for i in xrange(64)]
+
+    do_or_distribute(requests, 2, handler, launcher = "local", initializer = build_worker_context)
+
+    assert_equal(results, dict((i, i * (i - 1) // 2) for i in xrange(64)))
+
+    # over ssh, workers are spread across hosts
+    pool = SSHWorkerPool("tcp://manager:1", ["a", "b"], worker_arguments = ["--dealer"])
+
+    assert_equal(pool.build(0)[0], "a.0")
+    assert_equal(pool.build(3)[0], "b.3")
+    assert_equal(pool.build(1)[1][-7:], ["b", "python", "-m", "cargo.tools.labor.work2", "--dealer", "tcp://manager:1", "b.1"])
+
+    # worker output is logged, and repeated failures to start are fatal
+    core = ManagerCore([Task(abs, [-i]) for i in xrange(4)])
+    command = [sys.executable, "-c", "import sys; sys.exit(sys.argv[-1])"]
+
+    with mkdtemp_scoped() as box_path:
+        pool = ProcessWorkerPool("tcp://127.0.0.1:0", command = command, interval = 0.0, log_directory = box_path, max_failures = 3)
+
+        def adjust_until_failure():
+            for _ in xrange(1000):
+                pool.adjust(core)
+
+                time.sleep(0.01)
+
+        try:
+            assert_raises(RuntimeError, adjust_until_failure)
+        finally:
+            pool.close()
+
+        assert_equal(pool.failures, 3)
+
+        with open(os.path.join(box_path, "local.0.log")) as log_file:
+            assert_equal(log_file.read(), "local.0\n")
+
+    # a worker that exits after connecting is released, with its leases
+    core = ManagerCore([Task(abs, [-i]) for i in xrange(4)])
+    pool = ProcessWorkerPool("tcp://127.0.0.1:0", command = [sys.executable, "-c", "pass"])
+
+    try:
+        (worker_id,) = pool.submit(1)
+
+        core.handle(ApplyMessage(worker_id, 2))
+        pool.processes[worker_id].wait()
+
+        assert_equal(pool.adjust(core), [worker_id])
+        assert_equal(pool.failures, 0)
+    finally:
+        pool.close()
+
+def test_reduce_or_distribute():
+    """
+    Test merging task results into one aggregate.
+    """
+
+    import operator
+    import numpy
+
+    from cargo.labor2 import (
+        Task,
+        Speculator,
+        ManagerCore,
+        ApplyMessage,
+        DoneMessage,
+        BatchMessage,
+        PartialResult,
+        TreeReducer,
+        reduce_or_distribute,
+        )
+
+    # values are merged pairwise
+    merges = []
+
+    def concatenate(a, b):
+        merges.append((len(a), len(b)))
+
+        return a + b
+
+    reducer = TreeReducer(concatenate)
+
+    for i in xrange(8):
+        reducer.add([i])
+
+    assert_equal(reducer.result(), range(8))
+    assert_equal(sorted(set(merges)), [(1, 1), (2, 2), (4, 4)])
+
+    # a partial aggregate covering a duplicated task is rejected
+    tasks = [Task(abs, [-i]) for i in xrange(4)]
+    core = ManagerCore(tasks, speculator = Speculator())
+
+    (leased, _) = core.handle(ApplyMessage(0, count = 4))
+
+    core.handle(BatchMessage(0, [DoneMessage(0, leased[0].key, 0, 1.0)], count = 0))
+
+    done = [DoneMessage(0, task.key, None, 1.0) for task in leased[:2]]
+    (_, completed) = core.handle(BatchMessage(0, done, count = 0, partial = PartialResult(1)))
+
+    assert_equal(completed, [])
+    assert_equal(core.unstarted_count(), 1)
+
+    done = [DoneMessage(0, task.key, None, 1.0) for task in leased[2:]]
+    (_, completed) = core.handle(BatchMessage(0, done, count = 0, partial = PartialResult(5)))
+
+    assert_equal([result.value for (_, result) in completed], [5])
+    assert_equal(core.unfinished_count(), 1)
+
+    # end to end
+    requests = [(numpy.ones, [4]) for _ in xrange(64)]
+
+    for (workers, options) in [(0, {}), (2, {"threaded": True}), (2, {"launcher": "local"})]:
+        total = reduce_or_distribute(requests, workers, operator.add, **options)
+
+        assert_equal(total.tolist(), [64.0] * 4)
+
+    assert_equal(reduce_or_distribute([], 0, operator.add), None)
+
+def test_work2_relay():
+    """
+    Test relaying work2 tasks to local worker processes.
+    """
+
+    import os
+    import numpy
+
+    from cargo.labor2 import (
+        Task,
+        do_or_distribute,
+        )
+
+    # tasks run, and initializers run, in the relay's processes
+    results = []
+
+    def handler(task, result):
+        results.append(result)
+
+    requests = [(read_worker_context, [i]) for i in xrange(32)]
+
+    do_or_distribute(
+        requests,
+        1,
+        handler,
+        launcher = "local",
+        worker_processes = 2,
+        initializer = build_worker_context,
+        )
+
+    assert_equal(sorted(i for (i, _, _) in results), range(32))
+
+    for (_, context_pid, task_pid) in results:
+        assert_equal(context_pid, task_pid)
+        assert_true(task_pid != os.getpid())
+
+    # a shared argument reaches every process
+    shared = numpy.arange(2**16)
+    products = {}
+
+    def handler(task, result):
+        products[task.key] = result
+
+    requests = [Task(numpy.dot, [shared, shared], key = i) for i in xrange(16)]
+
+    do_or_distribute(requests, 1, handler, launcher = "local", worker_processes = 2)
+
+    assert_equal(products, dict((i, numpy.dot(shared, shared)) for i in xrange(16)))
+
+def test_task_groups():
+    """
+    Test cancelling the other members of a task group once one completes.
+    """
+
+    import time
+
+    from cargo.labor2 import (
+        Task,
+        ManagerCore,
+        ApplyMessage,
+        DoneMessage,
+        RemoteManager,
+        do_or_distribute,
+        )
+
+    # the first completion wins
+    racers = [Task(abs, [-i], group = "race") for i in xrange(3)]
+    dependent = Task(abs, [racers[2]])
+    bystander = Task(abs, [-3])
+    core = ManagerCore(racers + [dependent, bystander])
+
+    (leased, _) = core.handle(ApplyMessage(0))
+
+    assert_equal(leased, [racers[0]])
+
+    (leased, _) = core.handle(ApplyMessage(1))
+
+    assert_equal(leased, [racers[1]])
+
+    (leased, completed) = core.handle(DoneMessage(0, racers[0].key, 0, 1.0))
+
+    assert_equal(completed, [(racers[0], 0)])
+    assert_equal(leased, [bystander])
+    assert_equal(core.cancellations(), [(1, racers[1].key)])
+    assert_equal(core.cancellations(), [])
+    assert_equal(core.unfinished_count(), 1)
+    assert_equal(core.unstarted_count(), 0)
+
+    # the losers' results are discarded
+    (_, completed) = core.handle(DoneMessage(1, racers[1].key, 1, 1.0))
+
+    assert_equal(completed, [])
+
+    # a worker is leased one member of a group at a time
+    racers = [Task(abs, [-i], group = "race") for i in xrange(2)]
+    bystander = Task(abs, [-2], priority = -1)
+    core = ManagerCore(racers + [bystander])
+
+    (leased, _) = core.handle(ApplyMessage(0, 3))
+
+    assert_equal(leased, [racers[0]])
+
+    (leased, _) = core.handle(ApplyMessage(1, 3))
+
+    assert_equal(leased, [racers[1], bystander])
+
+    # end to end, a running loser is abandoned, or its worker dismissed
+    def distribute_rep(requests, workers, handler):
+        RemoteManager.distribute(requests, workers, handler, asynchronous = False, launcher = "local")
+
+    settings = [
+        (do_or_distribute, {"local": True}),
+        (do_or_distribute, {"launcher": "local"}),
+        (distribute_rep, {}),
+        ]
+
+    for (distribute, options) in settings:
+        results = []
+
+        def handler(task, result):
+            results.append(result)
+
+        requests = [
+            Task(time.sleep, [60.0], group = "race", priority = 1),
+            Task(abs, [-1], group = "race"),
+            ]
+
+        started = time.time()
+
+        distribute(requests, 3, handler, **options)
+
+        assert_equal(results, [1])
+        assert_true(time.time() - started < 30.0)
+
+def interrupt_once(n):
+    """Save progress and interrupt this worker, unless resuming; for test_checkpoints."""
+
+    import os
+    import time
+    import signal
+    import cargo.labor2
+
+    task = cargo.labor2.get_task()
+
+    if task.checkpoint is None:
+        task.save(n)
+
+        os.kill(os.getpid(), signal.SIGINT)
+
+        time.sleep(60.0)
+
+    return task.checkpoint * 2
+
+def test_checkpoints():
+    """
+    Test resuming an interrupted task from its saved state.
+    """
+
+    from cargo.labor2 import (
+        Task,
+        ManagerCore,
+        ApplyMessage,
+        InterruptedMessage,
+        do_or_distribute,
+        )
+
+    # a checkpoint reaches the next worker assigned the task
+    task = Task(abs, [-1])
+    core = ManagerCore([task])
+
+    (leased, _) = core.handle(ApplyMessage(0))
+
+    core.handle(InterruptedMessage(0, task.key, {task.key: "progress"}))
+
+    (leased, _) = core.handle(ApplyMessage(1))
+
+    assert_equal([t.key for t in leased], [task.key])
+    assert_equal(leased[0].checkpoint, "progress")
+    assert_equal(task.checkpoint, None)
+
+    # end to end, through local processes
+    results = []
+
+    def handler(task, result):
+        results.append(result)
+
+    do_or_distribute([(interrupt_once, [21])], 2, handler, local = True)
+
+    assert_equal(results, [42])
+
+def test_manager_core_memory():
+    """
+    Test the compact bookkeeping of tasks.
+    """
+
+    import pickle
+
+    from cargo.labor2 import (
+        Task,
+        TaskState,
+        ManagerCore,
+        ApplyMessage,
+        DoneMessage,
+        ConsumedList,
+        )
+    from cargo.tools.labor.benchmark import measure_core_memory
+
+    # slotted tasks still pickle, under any protocol
+    task = Task(abs, [-1], key = "a", priority = 2)
+
+    for protocol in [0, pickle.HIGHEST_PROTOCOL]:
+        copied = pickle.loads(pickle.dumps(task, protocol))
+
+        assert_equal((copied.key, copied.args, copied.priority), ("a", [-1], 2))
+
+    # unassigned tasks share a mapping of workers
+    tasks = ConsumedList(Task(abs, [-i]) for i in xrange(4))
+    core = ManagerCore(tasks)
+
+    assert_equal(len(tasks), 0)
+    assert_true(all(t.working is TaskState.unassigned for t in core.tstates.values()))
+
+    (leased, _) = core.handle(ApplyMessage(0))
+
+    assert_true(core.tstates[leased[0].key].working is not TaskState.unassigned)
+    assert_equal(TaskState.unassigned, {})
+
+    # completed tasks are released
+    core.handle(DoneMessage(0, leased[0].key, 0))
+
+    assert_equal(len(core.tstates), 3)
+
+    measured = measure_core_memory(256)
+
+    assert_equal(measured["retained_tasks"], 0)
+
+    # and so are their payloads
+    measured = measure_core_memory(16, 2**10)
+
+    assert_equal(measured["retained_tasks"], 0)
+    assert_equal(measured["retained_arguments"], 0)
+    assert_equal(measured["retained_segments"], 0)
+
+def test_remote_manager_router():
+    """
+    Test serving several in-flight tasks per worker through a ROUTER socket.
+    """
+
+    import threading
+    import zmq
+
+    from cargo.labor2 import (
+        Task,
+        RemoteManager,
+        ApplyMessage,
+        DoneMessage,
+        send_pyobj_gz,
+        recv_pyobj_gz,
+        )
+
+    results = {}
+
+    def handler(task, result):
+        results[task.args[0]] = result
+
+    context = zmq.Context()
+    router = context.socket(zmq.ROUTER)
+
+    router.bind("inproc://test_remote_manager_router")
+
+    manager = RemoteManager([Task(abs, [-i]) for i in xrange(8)], handler, router)
+    thread = threading.Thread(target = manager.manage)
+
+    thread.daemon = True
+
+    thread.start()
+
+    dealers = []
+
+    try:
+        # each worker holds four tasks at once
+        leased = []
+
+        for condor_id in xrange(2):
+            dealer = context.socket(zmq.DEALER)
+
+            dealer.setsockopt(zmq.LINGER, 0)
+            dealer.connect("inproc://test_remote_manager_router")
+
+            send_pyobj_gz(dealer, ApplyMessage(condor_id, 4))
+
+            tasks = recv_pyobj_gz(dealer)
+
+            assert_equal(len(tasks), 4)
+
+            dealers.append(dealer)
+            leased.append(tasks)
+
+        # and completes them in reverse order of assignment, interleaved
+        for (a, b) in zip(reversed(leased[0]), reversed(leased[1])):
+            send_pyobj_gz(dealers[0], DoneMessage(0, a.key, a(), 0.1))
+            send_pyobj_gz(dealers[1], DoneMessage(1, b.key, b(), 0.1))
+
+        thread.join(10.0)
+
+        assert_true(not thread.is_alive())
+        assert_equal(results, dict((-i, i) for i in xrange(8)))
+        assert_equal(manager.core.metrics.counters["tasks.completed"], 8)
+    finally:
+        for dealer in dealers:
+            dealer.close()
+
+        router.close()
+        context.term()
@@ -0,0 +1,256 @@
+"""@author: Bryan Silverthorn <bcs@cargo-cult.org>"""
+
+import plac
+
+if __name__ == "__main__":
+    from cargo.tools.labor.benchmark import main
+
+    plac.call(main)
+
+import os
+import sys
+import json
+import time
+import resource
+import itertools
+import numpy
+import cargo
+
+from cargo.labor2 import (
+    Task,
+    DoneMessage,
+    ManagerCore,
+    WorkerState,
+    SharedMemoryCodec,
+    SharedArgumentIndex,
+    ThreadManager,
+    LocalManager,
+    RemoteManager,
+    launch_local_workers,
+    launch_remote_workers,
+    launch_thread_workers,
+    )
+
+logger = cargo.get_logger(__name__, level = "NOTSET")
+
+def noop():
+    """Do nothing."""
+
+def nap(seconds):
+    """Sleep for some time."""
+
+    time.sleep(seconds)
+
+def echo(payload):
+    """Return the payload."""
+
+    return payload
+
+def build_tasks(kind, count, size, seconds):
+    """Build a list of synthetic tasks."""
+
+    if kind == "noop":
+        return [Task(noop) for _ in xrange(count)]
+    elif kind == "sleep":
+        return [Task(nap, [seconds]) for _ in xrange(count)]
+    elif kind == "payload":
+        # distinct payloads, so that none are shared between tasks
+        return [Task(echo, [numpy.frombuffer(numpy.random.bytes(size), numpy.uint8)]) for _ in xrange(count)]
+    else:
+        raise ValueError("unrecognized task kind \"{0}\"".format(kind))
+
+def get_cpu_seconds():
+    """Return the CPU time used by this process so far."""
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    return usage.ru_utime + usage.ru_stime
+
+def get_resident_bytes():
+    """Return the resident set size of this process; requires /proc."""
+
+    with open("/proc/self/statm") as statm_file:
+        return int(statm_file.read().split()[1]) * resource.getpagesize()
+
+def measure_core_memory(count, size = 0):
+    """Measure the bookkeeping cost of unfinished tasks; return a dictionary of measurements.
+
+    Without a payload size, the tasks take no arguments, so only the core's
+    structures, and the tasks themselves, are counted. Every task is then
+    completed, to check that none is retained; a payload of size bytes is
+    passed along, as RemoteManager and LocalManager would pass it, to check
+    that none of those is retained either.
+    """
+
+    def build(i):
+        if size > 0:
+            return Task(echo, [numpy.frombuffer(numpy.random.bytes(size), numpy.uint8)])
+        else:
+            return Task(noop)
+
+    before = get_resident_bytes()
+    core = ManagerCore(build(i) for i in xrange(count))
+    admitted = get_resident_bytes()
+
+    wstate = WorkerState(0)
+    shared = SharedArgumentIndex(threshold = 1)
+
+    with cargo.mkdtemp_scoped() as directory:
+        inputs = SharedMemoryCodec(directory, threshold = 1, persistent = True)
+
+        while core.unfinished_count() > 0:
+            for task in core.lease(wstate, 64, time.time()):
+                inputs.encode(shared.prepare([task], []), task.key)
+                core.complete(wstate, DoneMessage(0, task.key, None, 0.0), time.time())
+                shared.release(task.key)
+                inputs.release(task.key)
+
+        retained_segments = len(os.listdir(directory))
+
+    return {
+        "count": count,
+        "size": size,
+        "bytes_per_task": float(admitted - before) / count,
+        "retained_tasks": len(core.tstates),
+        "retained_arguments": len(shared.by_id),
+        "retained_segments": retained_segments,
+        }
+
+class Gate(object):
+    """Hold tasks until every worker has checked in, then start the clock.
+
+    Keeps worker startup out of the measurement.
+    """
+
+    def __init__(self, workers):
+        """Initialize."""
+
+        self.workers = workers
+        self.core = None
+        self.opened = None
+        self.cpu_seconds = None
+
+    def __call__(self):
+        """Should tasks still be held?"""
+
+        if self.opened is None:
+            if self.core is None or len(self.core.wstates) < self.workers:
+                return True
+
+            self.opened = time.time()
+            self.cpu_seconds = get_cpu_seconds()
+
+        return False
+
+def run_benchmark(backend, kind, workers, count, size = 0, seconds = 0.01):
+    """Time one configuration; return a dictionary of measurements.
+
+    Manager CPU time is that of this process, so it includes the workers
+    themselves under the threads backend.
+    """
+
+    tasks = build_tasks(kind, count, size, seconds)
+    gate = Gate(workers)
+    completed = []
+
+    def handler(task, result):
+        completed.append(task.key)
+
+    if backend == "threads":
+        with launch_thread_workers(workers) as (stm_queue, threads):
+            manager = ThreadManager(stm_queue, tasks, threads, handler, hold = gate)
+            gate.core = manager.core
+
+            manager.manage()
+    elif backend == "local":
+        with launch_local_workers(workers) as (stm_queue, processes, directory):
+            manager = LocalManager(stm_queue, tasks, processes, handler, directory, hold = gate)
+            gate.core = manager.core
+
+            manager.manage()
+    elif backend == "remote":
+        # work2 processes on this machine stand in for Condor jobs
+        with launch_remote_workers(workers, minimum = workers, launcher = "local") as (zmq_socket, pool):
+            manager = RemoteManager(tasks, handler, zmq_socket, pool = pool, hold = gate)
+            gate.core = manager.core
+
+            pool.adjust(manager.core)
+            manager.manage()
+    else:
+        raise ValueError("unrecognized backend \"{0}\"".format(backend))
+
+    wall_seconds = time.time() - gate.opened
+    cpu_seconds = get_cpu_seconds() - gate.cpu_seconds
+
+    assert len(completed) == count
+
+    if kind == "sleep":
+        busy_seconds = count * seconds
+    else:
+        busy_seconds = 0.0
+
+    return {
+        "backend": backend,
+        "kind": kind,
+        "workers": workers,
+        "count": count,
+        "size": size,
+        "wall_seconds": wall_seconds,
+        "tasks_per_second": count / wall_seconds,
+        "overhead_ms": 1e3 * max(0.0, wall_seconds * workers - busy_seconds) / count,
+        "manager_cpu_seconds": cpu_seconds,
+        "manager_cpu_ms_per_task": 1e3 * cpu_seconds / count,
+        }
+
+@plac.annotations(
+    backends = ("comma-separated backends (threads, local, remote)", "option", "b"),
+    kinds = ("comma-separated task kinds (noop, sleep, payload)", "option", "k"),
+    workers = ("comma-separated worker counts", "option", "w"),
+    sizes = ("comma-separated payload sizes, in bytes", "option", "s"),
+    count = ("tasks per run", "option", "n", int),
+    seconds = ("duration of each sleep task", "option", "z", float),
+    output = ("file to which results are written", "option", "o"),
+    memory = ("measure core memory per task, rather than dispatch", "flag", "m"),
+    )
+def main(
+    backends = "local,remote",
+    kinds = "noop,sleep,payload",
+    workers = "1,2,4",
+    sizes = "1024,1048576",
+    count = 1000,
+    seconds = 0.01,
+    output = None,
+    memory = False,
+    ):
+    """Measure labor2 dispatch overhead; write one JSON line per run."""
+
+    cargo.enable_default_logging()
+
+    if output is None:
+        output_file = sys.stdout
+    else:
+        output_file = open(output, "w")
+
+    try:
+        if memory:
+            for size in [0] + map(int, sizes.split(",")):
+                output_file.write(json.dumps(measure_core_memory(count, size), sort_keys = True) + "\n")
+
+            return
+
+        for (backend, kind, nworkers) in itertools.product(backends.split(","), kinds.split(","), workers.split(",")):
+            if kind == "payload":
+                kind_sizes = map(int, sizes.split(","))
+            else:
+                kind_sizes = [0]
+
+            for size in kind_sizes:
+                logger.info("benchmarking %s %s tasks on %s workers", backend, kind, nworkers)
+
+                measured = run_benchmark(backend, kind, int(nworkers), count, size, seconds)
+
+                output_file.write(json.dumps(measured, sort_keys = True) + "\n")
+                output_file.flush()
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
@@ -7,112 +7,666 @@ if __name__ == "__main__":
 
     plac.call(main)
 
+import os
+import sys
+import time
+import signal
 import numpy
 import random
 import traceback
+import threading
+import collections
 import zmq
 import cargo
 
 logger = cargo.get_logger(__name__, level = "NOTSET")
 
-def work_once(condor_id, req_socket, task):
-    """Request and/or complete a single unit of work."""
+class Heartbeat(threading.Thread):
+    """Periodically tell the manager that a worker is alive.
 
-    # get an assignment
-    if task is None:
-        cargo.send_pyobj_gz(
-            req_socket,
-            cargo.labor2.ApplyMessage(condor_id),
-            )
+    The manager may answer with notice that a task was cancelled, which is
+    passed on to the worker.
+    """
 
-        task = cargo.recv_pyobj_gz(req_socket)
+    def __init__(self, context, req_address, worker, interval):
+        """Initialize."""
 
-        if task is None:
-            logger.info("received null assignment; terminating")
+        threading.Thread.__init__(self)
 
-            return None
+        self.context = context
+        self.req_address = req_address
+        self.worker = worker
+        self.interval = interval
+        self.stopped = threading.Event()
 
-    # complete the assignment
-    try:
-        cargo.labor2._current_task = task
+        self.daemon = True
+
+    def run(self):
+        """Send heartbeats until stopped."""
 
-        logger.info("starting work on task %s", task.key)
+        # zeromq sockets must not be shared between threads
+        beat_socket = self.context.socket(zmq.DEALER)
 
-        result = task()
-    except KeyboardInterrupt, error:
-        logger.warning("interruption during task %s", task.key)
+        beat_socket.setsockopt(zmq.LINGER, 0)
+        beat_socket.connect(self.req_address)
 
-        cargo.send_pyobj_gz(
-            req_socket,
-            cargo.labor2.InterruptedMessage(condor_id, task.key),
-            )
+        try:
+            while not self.stopped.is_set():
+                (key, started) = self.worker.current
 
-        req_socket.recv()
-    except BaseException, error:
-        description = traceback.format_exc(error)
+                if started is None:
+                    elapsed = None
+                else:
+                    elapsed = time.time() - started
 
-        logger.warning("error during task %s:\n%s", task.key, description)
+                cargo.send_pyobj_gz(
+                    beat_socket,
+                    cargo.labor2.HeartbeatMessage(self.worker.condor_id, key, elapsed),
+                    [""],
+                    )
 
-        cargo.send_pyobj_gz(
-            req_socket,
-            cargo.labor2.ErrorMessage(condor_id, task.key, description),
-            )
+                deadline = time.time() + self.interval
 
-        req_socket.recv()
-    else:
-        logger.info("finished task %s", task.key)
+                while not self.stopped.is_set() and time.time() < deadline:
+                    if beat_socket.poll(100):
+                        # skip the empty delimiter frame
+                        frames = beat_socket.recv_multipart(copy = False)
+                        notice = cargo.labor2.default_codec.decode(frames[1:])
+
+                        if isinstance(notice, cargo.labor2.Cancellation):
+                            self.worker.cancel(notice.key)
+        finally:
+            beat_socket.close()
 
-        cargo.send_pyobj_gz(
-            req_socket,
-            cargo.labor2.DoneMessage(condor_id, task.key, result),
-            )
+    def stop(self):
+        """Stop sending heartbeats."""
 
-        return cargo.recv_pyobj_gz(req_socket)
+        self.stopped.set()
 
-    cargo.labor2._current_task = None
+        self.join()
+
+class Worker(object):
+    """Request and complete units of work from a manager."""
+
+    def __init__(self, condor_id, req_socket, sizer, cache):
+        """Initialize."""
+
+        self.condor_id = condor_id
+        self.req_socket = req_socket
+        self.sizer = sizer
+        self.cache = cache
+        self.current = (None, None)
+        self.metrics = cargo.labor2.Metrics()
+        self.combine = None
+        self.cancelling = None
+
+    def run(self, task):
+        """Complete a task, noting it as current meanwhile."""
+
+        cargo.labor2._current_task = task
 
-    return None
+        logger.debug("starting work on task %s", task.key)
 
-def work_loop(condor_id, req_socket):
-    """Repeatedly request and complete units of work."""
+        started = time.time()
 
-    task = None
+        self.current = (task.key, started)
 
-    while True:
         try:
-            task = work_once(condor_id, req_socket, task)
-        except Exception:
-            raise
+            return task()
+        finally:
+            self.current = (None, None)
+
+            self.metrics.observe("task.run_seconds", time.time() - started)
+
+            cargo.labor2._current_task = None
+
+    def cancel(self, key):
+        """Abandon a task, if it is still running; called from another thread."""
+
+        if self.current[0] == key:
+            self.cancelling = key
+
+            os.kill(os.getpid(), signal.SIGUSR1)
+
+    def handle_sigusr1(self, number, frame):
+        """Interrupt a task that was cancelled."""
+
+        if self.cancelling is not None and self.cancelling == self.current[0]:
+            self.cancelling = None
+
+            raise cargo.labor2.TaskCancelledError()
+
+    def send(self, message):
+        """Send a message to the manager."""
+
+        cargo.send_pyobj_gz(self.req_socket, message)
+
+    def send_request(self, message):
+        """Send a request for tasks, advertising our cached arguments."""
+
+        message.cached = self.cache.advertise()
+
+        self.send(message)
+
+    def recv_reply(self, message):
+        """Receive the assignment answering a request."""
+
+        waited = time.time()
+        received = cargo.recv_pyobj_gz(self.req_socket)
+
+        while isinstance(received, cargo.labor2.Postponement):
+            # the manager is holding dispatch; ask again shortly
+            time.sleep(received.seconds)
+
+            self.cache.release(message.cached)
+
+            message = cargo.labor2.ApplyMessage(self.condor_id, getattr(message, "count", 1))
+
+            self.send_request(message)
+
+            received = cargo.recv_pyobj_gz(self.req_socket)
+
+        self.metrics.observe("worker.idle_seconds", time.time() - waited)
+
+        if received and isinstance(received[0], cargo.labor2.WorkerSetup):
+            self.set_up(received.pop(0))
+
+        tasks = self.cache.resolve(received)
+
+        self.cache.release(message.cached)
+
+        return tasks
+
+    def set_up(self, setup):
+        """Prepare to work, as directed by the manager."""
+
+        cargo.labor2.initialize_worker(setup.initializer)
+
+        self.combine = setup.combine
+
+    def report(self, finished, count):
+        """Build a message reporting finished tasks, and requesting more."""
+
+        if self.combine is None or not finished:
+            return cargo.labor2.BatchMessage(self.condor_id, finished, count)
+        else:
+            partial = reduce(self.combine, (done.result for done in finished))
+
+            for done in finished:
+                done.result = None
+
+            return \
+                cargo.labor2.BatchMessage(
+                    self.condor_id,
+                    finished,
+                    count,
+                    partial = cargo.labor2.PartialResult(partial),
+                    )
+
+    def exchange(self, message):
+        """Send a request for tasks and return the assignment."""
+
+        self.send_request(message)
+
+        return self.recv_reply(message)
+
+    def work_once(self, tasks):
+        """Request and/or complete a single lease of work."""
+
+        # get an assignment
+        if not tasks:
+            tasks = self.exchange(cargo.labor2.ApplyMessage(self.condor_id, self.sizer.size()))
+
+            if not tasks:
+                logger.info("received null assignment; terminating")
+
+                return None
+
+        # complete the assignment
+        finished = []
+
+        for task in tasks:
+            try:
+                started = time.time()
+                result = self.run(task)
+            except cargo.labor2.TaskCancelledError:
+                logger.info("abandoning cancelled task %s", task.key)
+            except KeyboardInterrupt, error:
+                logger.warning("interruption during task %s", task.key)
+
+                if finished:
+                    self.exchange(self.report(finished, 0))
+
+                self.send(cargo.labor2.InterruptedMessage(self.condor_id, task.key, {task.key: task.checkpoint}))
+
+                self.req_socket.recv_multipart()
+
+                break
+            except BaseException, error:
+                description = traceback.format_exc(error)
+
+                logger.warning("error during task %s:\n%s", task.key, description)
+
+                if finished:
+                    self.exchange(self.report(finished, 0))
+
+                self.send(cargo.labor2.ErrorMessage(self.condor_id, task.key, description))
+
+                self.req_socket.recv_multipart()
+
+                break
+            else:
+                logger.debug("finished task %s", task.key)
+
+                duration = time.time() - started
+
+                self.sizer.observe(duration)
+
+                finished.append(cargo.labor2.DoneMessage(self.condor_id, task.key, result, duration))
+        else:
+            tasks = \
+                self.exchange(
+                    self.report(finished, self.sizer.size()),
+                    )
+
+            if tasks:
+                return tasks
+
+        return None
+
+    def work_loop(self):
+        """Repeatedly request and complete units of work."""
+
+        tasks = []
+
+        while True:
+            tasks = self.work_once(tasks)
+
+            if tasks is None:
+                break
+
+    def work_dealer(self, prefetch):
+        """Complete units of work, prefetching assignments asynchronously."""
+
+        pending = collections.deque()
+        requested = collections.deque()
+        finished = []
+
+        def request(message):
+            self.send_request(message)
+
+            requested.append(message)
+
+        request(cargo.labor2.ApplyMessage(self.condor_id, self.sizer.size() + prefetch))
+
+        while True:
+            # collect assignments, waiting only if we have nothing to do
+            while requested and (not pending or self.req_socket.poll(0)):
+                pending.extend(self.recv_reply(requested.popleft()))
+
+            if not pending:
+                logger.info("received null assignment; terminating")
+
+                return
+
+            # complete the next assignment
+            task = pending.popleft()
+
+            try:
+                started = time.time()
+                result = self.run(task)
+            except cargo.labor2.TaskCancelledError:
+                logger.info("abandoning cancelled task %s", task.key)
+            except KeyboardInterrupt, error:
+                logger.warning("interruption during task %s", task.key)
+
+                if finished:
+                    request(self.report(finished, 0))
+
+                self.send(cargo.labor2.InterruptedMessage(self.condor_id, task.key, {task.key: task.checkpoint}))
+
+                return
+            except BaseException, error:
+                description = traceback.format_exc(error)
+
+                logger.warning("error during task %s:\n%s", task.key, description)
+
+                if finished:
+                    request(self.report(finished, 0))
+
+                self.send(cargo.labor2.ErrorMessage(self.condor_id, task.key, description))
+
+                return
+            else:
+                logger.debug("finished task %s", task.key)
+
+                duration = time.time() - started
 
-        if task is None:
-            break
+                self.sizer.observe(duration)
+
+                finished.append(cargo.labor2.DoneMessage(self.condor_id, task.key, result, duration))
+
+            # report results, and top up our assignments, once per lease
+            if len(finished) >= self.sizer.size() or len(pending) <= prefetch:
+                wanted = \
+                    self.sizer.size() \
+                    + prefetch \
+                    - len(pending) \
+                    - sum(m.count for m in requested)
+
+                request(self.report(finished, max(0, wanted)))
+
+                finished = []
+
+class Relay(Worker):
+    """Request units of work from a manager, and complete them in local processes.
+
+    The processes, started by launch_local_workers(), are handed one task
+    at a time through a SharedMemoryCodec whose segments persist, so that
+    each cached array argument is written to shared memory once and mapped
+    by every process. Results are reported, and leases requested, for the
+    processes together.
+    """
+
+    def __init__(self, condor_id, req_socket, sizer, cache, stm_queue, processes, directory, dealer = True):
+        """Initialize."""
+
+        Worker.__init__(self, condor_id, req_socket, sizer, cache)
+
+        self.stm_queue = stm_queue
+        self.processes = dict((process.pid, process) for process in processes)
+        self.inputs = cargo.labor2.SharedMemoryCodec(directory, persistent = True)
+        self.outputs = cargo.labor2.SharedMemoryCodec(directory)
+        self.dealer = dealer
+        self.setup = None
+        self.initialized = set()
+        self.running = {}
+
+    def set_up(self, setup):
+        """Prepare to work, as directed by the manager."""
+
+        # the initializer runs in the processes, not here
+        self.setup = setup
+        self.combine = setup.combine
+
+    def assign(self, pid, task):
+        """Hand one task to an idle process."""
+
+        tasks = [task]
+
+        if self.setup is not None and pid not in self.initialized:
+            self.initialized.add(pid)
+
+            tasks = [self.setup] + tasks
+
+        self.running[pid] = (task.key, time.time())
+        self.current = min(self.running.itervalues(), key = lambda (_, started): started)
+
+        self.processes[pid].mts_queue.put(self.inputs.encode(tasks, pid))
+
+    def cancel(self, key):
+        """Tell the process running a task, if any, to abandon it."""
+
+        for (pid, (running, _)) in self.running.items():
+            if running == key:
+                self.processes[pid].cancel(key)
+
+    def finish(self, pid):
+        """Note that a process is no longer working on its task."""
+
+        self.running.pop(pid, None)
+        self.inputs.release(pid)
+
+        if self.running:
+            self.current = min(self.running.itervalues(), key = lambda (_, started): started)
+        else:
+            self.current = (None, None)
+
+    def work_relay(self, prefetch, grace = 5.0):
+        """Complete units of work in the processes, prefetching assignments.
+
+        If interrupted, the relay waits up to grace seconds for its busy
+        processes to save, and report, their progress.
+        """
+
+        pending = collections.deque()
+        requested = collections.deque()
+        idle = collections.deque()
+        finished = []
+
+        def request(message):
+            self.send_request(message)
+
+            requested.append(message)
+
+        def abandon(message):
+            # a REQ socket must collect each reply before sending again
+            if not self.dealer:
+                while requested:
+                    self.recv_reply(requested.popleft())
+
+            if finished:
+                request(self.report(finished, 0))
+
+                if not self.dealer:
+                    self.recv_reply(requested.popleft())
+
+            self.send(message)
+
+            if not self.dealer:
+                self.req_socket.recv_multipart()
+
+        def interrupt(message):
+            # let the processes still working save their progress
+            for pid in self.running:
+                os.kill(pid, signal.SIGINT)
+
+            checkpoints = dict(message.checkpoints)
+            deadline = time.time() + grace
+
+            while self.running and time.time() < deadline:
+                if not queue_socket.poll(1000 * max(0.0, deadline - time.time())):
+                    break
+
+                received = self.outputs.decode(queue_socket.recv())
+
+                self.finish(received.sender)
+
+                if isinstance(received, cargo.labor2.DoneMessage):
+                    received.sender = self.condor_id
+
+                    finished.append(received)
+                elif isinstance(received, cargo.labor2.InterruptedMessage):
+                    checkpoints.update(received.checkpoints)
+
+            message.checkpoints = checkpoints
+
+            abandon(message)
+
+        def wanted():
+            return \
+                len(self.processes) * self.sizer.size() \
+                + prefetch \
+                - len(pending) \
+                - len(self.running) \
+                - sum(m.count for m in requested)
+
+        # the queue is forwarded to a socket, which can be polled alongside zeromq
+        poller = zmq.Poller()
+        forwarded = cargo.labor2.forward_queue(self.stm_queue, self.req_socket.context)
+
+        with forwarded as queue_socket:
+            poller.register(self.req_socket, zmq.POLLIN)
+            poller.register(queue_socket, zmq.POLLIN)
+
+            request(cargo.labor2.ApplyMessage(self.condor_id, wanted()))
+
+            try:
+                while True:
+                    poller.poll(1000)
+
+                    # collect assignments
+                    while requested and self.req_socket.poll(0):
+                        pending.extend(self.recv_reply(requested.popleft()))
+
+                    # collect messages from the processes
+                    while queue_socket.poll(0):
+                        message = self.outputs.decode(queue_socket.recv())
+
+                        pid = message.sender
+
+                        self.finish(pid)
+
+                        if isinstance(message, cargo.labor2.DoneMessage):
+                            logger.debug("process %i finished task %s", pid, message.key)
+
+                            self.sizer.observe(message.duration)
+
+                            message.sender = self.condor_id
+
+                            finished.append(message)
+                        elif isinstance(message, cargo.labor2.InterruptedMessage):
+                            message.sender = self.condor_id
+
+                            interrupt(message)
+
+                            return
+                        elif not isinstance(message, cargo.labor2.ApplyMessage):
+                            # an error, after which the process exits
+                            self.processes[pid].mts_queue.put(self.inputs.encode([]))
+
+                            message.sender = self.condor_id
+
+                            abandon(message)
+
+                            return
+
+                        idle.append(pid)
+
+                    for (pid, process) in self.processes.iteritems():
+                        if not process.is_alive():
+                            logger.warning("worker process %i died; terminating", pid)
+
+                            (key, _) = self.running.get(pid, (None, None))
+                            description = "worker process {0} died".format(pid)
+
+                            abandon(cargo.labor2.ErrorMessage(self.condor_id, key, description))
+
+                            return
+
+                    # hand out assignments
+                    while idle and pending:
+                        self.assign(idle.popleft(), pending.popleft())
+
+                    # report results, and top up our assignments, once per lease
+                    if not requested and not pending and not self.running:
+                        if not finished:
+                            logger.info("received null assignment; terminating")
+
+                            return
+
+                        request(self.report(finished, max(0, wanted())))
+
+                        finished = []
+                    elif finished and (self.dealer or not requested):
+                        if len(finished) >= len(self.processes) * self.sizer.size() or len(pending) <= prefetch:
+                            request(self.report(finished, max(0, wanted())))
+
+                            finished = []
+            except KeyboardInterrupt:
+                logger.warning("interruption during task %s", self.current[0])
+
+                interrupt(cargo.labor2.InterruptedMessage(self.condor_id, self.current[0]))
 
 @plac.annotations(
     req_address = ("zeromq address of master"),
     condor_id = ("condor process specifier"),
+    lease = ("tasks per request (0 to adapt)", "option", "l", int),
+    dealer = ("use an asynchronous DEALER socket", "flag", "d"),
+    prefetch = ("tasks to hold beyond the lease, if asynchronous", "option", "p", int),
+    compressor = ("message compressor", "option", "c", str, sorted(cargo.labor2.MessageCodec.compressors)),
+    cache = ("shared-argument cache capacity, in MiB", "option", "m", int),
+    heartbeat = ("seconds between heartbeats (0 to disable)", "option", "b", float),
+    processes = ("local processes to run tasks (0 to run them here)", "option", "n", int),
     )
-def main(req_address, condor_id):
+def main(
+    req_address,
+    condor_id,
+    lease = 0,
+    dealer = False,
+    prefetch = 1,
+    compressor = "zlib",
+    cache = 256,
+    heartbeat = 10.0,
+    processes = 0,
+    ):
     """Do arbitrary distributed work."""
 
     cargo.enable_default_logging()
 
+    if processes > 0:
+        # start the processes before zeromq is initialized
+        with cargo.labor2.launch_local_workers(processes) as local:
+            # let the processes be cleaned up if we are terminated
+            signal.signal(signal.SIGTERM, lambda number, frame: sys.exit(1))
+
+            work(req_address, condor_id, lease, dealer, prefetch, compressor, cache, heartbeat, local)
+    else:
+        work(req_address, condor_id, lease, dealer, prefetch, compressor, cache, heartbeat)
+
+def work(req_address, condor_id, lease, dealer, prefetch, compressor, cache, heartbeat, local = None):
+    """Connect to the manager and work, here or in local processes."""
+
     # connect to the work server
     logger.info("connecting to %s", req_address)
 
     context = zmq.Context()
 
-    req_socket = context.socket(zmq.REQ)
+    if dealer:
+        req_socket = context.socket(zmq.DEALER)
+    else:
+        req_socket = context.socket(zmq.REQ)
 
     req_socket.connect(req_address) 
 
     # enter the work loop
+    sizer = cargo.labor2.LeaseSizer(lease)
+    shared = cargo.labor2.SharedArgumentCache(cache * 2**20)
+
+    if local is None:
+        worker = Worker(condor_id, req_socket, sizer, shared)
+
+        signal.signal(signal.SIGUSR1, worker.handle_sigusr1)
+    else:
+        (stm_queue, processes, directory) = local
+
+        worker = Relay(condor_id, req_socket, sizer, shared, stm_queue, processes, directory, dealer)
+
+    cargo.labor2.default_codec = cargo.labor2.MessageCodec(compressor, metrics = worker.metrics)
+
+    if heartbeat > 0.0:
+        beating = Heartbeat(context, req_address, worker, heartbeat)
+
+        beating.start()
+    else:
+        beating = None
+
     try:
-        work_loop(condor_id, req_socket)
+        if local is not None:
+            worker.work_relay(prefetch)
+        elif dealer:
+            worker.work_dealer(prefetch)
+        else:
+            worker.work_loop()
     finally:
+        if beating is not None:
+            beating.stop()
+
+        logger.info("metrics (final): %s", worker.metrics.dumps())
+
         logger.info("flushing sockets and terminating zeromq context")
 
         req_socket.close()
         context.term()
 
         logger.info("zeromq cleanup complete")
-